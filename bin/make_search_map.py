@@ -3,16 +3,29 @@
 from lalinference import fits
 import numpy as np
 from optparse import OptionParser
+import os
 import sky_area.search as sch
 
+def beam_output(output, beam):
+    """Returns the output file name for the given beam, by inserting the
+    beam FWHM in degrees before the file extension.
+
+    """
+    base, ext = os.path.splitext(output)
+    if ext == '.gz':
+        base, ext2 = os.path.splitext(base)
+        ext = ext2 + ext
+
+    return '{0:s}_{1:g}deg{2:s}'.format(base, beam*180.0/np.pi, ext)
+
 if __name__ == '__main__':
     parser = OptionParser()
 
     parser.add_option('--output', help='output FITS file', default='search_map.fits.gz')
     parser.add_option('--samples', help='posterior samples file', default='posterior_samples.dat')
 
-    parser.add_option('--beam', default=1.0*np.pi/180.0, type='float', help='beam FWHM (in radians; default 1 degree)')
-    parser.add_option('--pix-per-beam', default=10, type='int', help='number of pixels per beam in output map')
+    parser.add_option('--beam', action='append', type='float', help='beam FWHM (in radians; default 1 degree); give more than once to produce one map per beam, with the beam in degrees inserted into the output file name')
+    parser.add_option('--pix-per-beam', default=10, type='int', help='number of pixels per beam in output map (for the smallest beam)')
 
     parser.add_option('--objid', help='ID to store in FITS header')
     parser.add_option('--gps-time', default=None, type='float', help='GPS time to store in FITS header')
@@ -26,8 +39,19 @@ if __name__ == '__main__':
     else:
         nest=True
 
+    if args.beam is None:
+        beams = [1.0*np.pi/180.0]
+    else:
+        beams = args.beam
+
     data = np.genfromtxt(args.samples, names=True)
-    hmap = sch.search_map(data['ra'], data['dec'], args.beam, nest=nest, pix_per_beam=args.pix_per_beam)
+    hmaps = sch.search_maps(data['ra'], data['dec'], beams, nest=nest, pix_per_beam=args.pix_per_beam)
+
+    for beam, hmap in zip(beams, hmaps):
+        if len(beams) == 1:
+            output = args.output
+        else:
+            output = beam_output(args.output, beam)
 
-    fits.write_sky_map(args.output, hmap, creator=parser.get_prog_name(),
-                       objid=args.objid, gps_time=args.gps_time, nest=nest)
+        fits.write_sky_map(output, hmap, creator=parser.get_prog_name(),
+                           objid=args.objid, gps_time=args.gps_time, nest=nest)
@@ -7,6 +7,7 @@ import matplotlib as mpl
 mpl.use('Agg')
 
 import matplotlib.pyplot as pp
+import multiprocessing as mp
 from optparse import OptionParser
 import plotutils.plotutils as pu
 import scipy.stats as ss
@@ -19,44 +20,107 @@ parser = OptionParser(USAGE)
 
 parser.add_option('--prefix', default='', help='output file prefix')
 parser.add_option('--noinj', action='store_true', default=False, help='disable injection-dependent processing')
+parser.add_option('--nproc', type='int', default=1, help='number of processes reading areas.dat files [default: %default]')
+parser.add_option('--npz', action='store_true', default=False, help='also write the collated areas, and the list of files read, to areas.npz')
+parser.add_option('--append', action='store_true', default=False, help='only read files not already in an existing areas.npz, and add them to it (implies --npz)')
+parser.add_option('--plot-cls', default='50,75,90', help='comma-separated credible levels (in percent) to plot, if present [default: %default]')
 
 options, args = parser.parse_args()
-cls = np.array([0.5, 0.75, 0.9])
-cls_header = ['area({0:d})'.format(int(round(100.0*cl))) for cl in cls]
-
-data = []
-dtype = np.dtype([('simulation_id', np.str, 250),
-                  ('p_value', np.float),
-                  ('searched_area', np.float),
-                  ('area50', np.float),
-                  ('area75', np.float),
-                  ('area90', np.float)])
+
+def column_field(column):
+    """Returns the array field name for a column header, e.g. ``area50``
+    for ``area(50)``.
+
+    """
+    return column.replace('(', '').replace(')', '')
+
+def field_column(field):
+    """Inverse of :func:`column_field`.
+
+    """
+    if field.startswith('area'):
+        return 'area({0:s})'.format(field[4:])
+    else:
+        return field
+
+def areas_dtype(fields):
+    return np.dtype([(f, np.str, 250) if f == 'simulation_id' else (f, np.float)
+                     for f in fields])
+
+def read_areas(file):
+    with open(file, 'r') as inp:
+        fields = [column_field(c) for c in inp.readline().split()]
+
+    return np.atleast_1d(np.loadtxt(file, dtype=areas_dtype(fields), skiprows=1))
+
+def collate(arrays):
+    """Concatenates structured arrays, taking the union of their fields;
+    missing areas are ``nan``.  The credible areas are ordered by
+    level.
+
+    """
+    fields = ['simulation_id', 'p_value', 'searched_area']
+    for a in arrays:
+        fields.extend([f for f in a.dtype.names if f not in fields])
+    fields[3:] = sorted(fields[3:], key=lambda f: float(f[4:]))
+    dtype = areas_dtype(fields)
+
+    data = np.zeros(sum(a.shape[0] for a in arrays), dtype=dtype)
+    for f in fields:
+        if f != 'simulation_id':
+            data[f] = np.nan
+
+    i = 0
+    for a in arrays:
+        for f in a.dtype.names:
+            data[f][i:i+a.shape[0]] = a[f]
+        i += a.shape[0]
+
+    return data
+
 if args==None or len(args)==0:
-  for file in glob.glob('*/areas.dat'):
-    data.append(np.loadtxt(file, dtype=dtype, skiprows=1))
+  files = sorted(glob.glob('*/areas.dat'))
 else:
-  for file in args:
-    data.append(np.loadtxt(file, dtype=dtype, skiprows=1))
-
-new_data = np.zeros(len(data), dtype=data[0].dtype)
-for i in range(len(data)):
-    new_data[i] = data[i][()]
-data = new_data
+  files = args
 
 options.prefix=os.path.realpath(options.prefix)
 
 if not os.path.isdir(options.prefix):
   os.makedirs(options.prefix)
 
+npz_file = os.path.join(options.prefix, 'areas.npz')
+old_files = []
+old_data = []
+if options.append and os.path.exists(npz_file):
+  old = np.load(npz_file)
+  old_files = list(old['files'])
+  fields = [f for f in old.files if f != 'files']
+  old_data = [np.zeros(len(old_files), dtype=areas_dtype(fields))]
+  for name in fields:
+    old_data[0][name] = old[name]
+  seen = set(old_files)
+  files = [file for file in files if file not in seen]
+
+if options.nproc > 1 and len(files) > 1:
+  pool = mp.Pool(options.nproc)
+  data = pool.map(read_areas, files, chunksize=max(1, len(files)//(4*options.nproc)))
+  pool.close()
+  pool.join()
+else:
+  data = [read_areas(file) for file in files]
+
+data = collate(old_data + data)
+files = old_files + files
+
+if options.npz or options.append:
+  columns = dict((name, data[name]) for name in data.dtype.names)
+  np.savez(npz_file, files=np.array(files), **columns)
+
 with bz2.BZ2File(os.path.join(options.prefix, 'areas.dat.bz2'), 'w') as out:
-    out.write('simulation_id\tp_value\tsearched_area\t' + '\t'.join(cls_header) + '\n')
+    out.write('\t'.join(field_column(f) for f in data.dtype.names) + '\n')
     for d in data:
-        out.write('{0:s}\t{1:g}\t{2:g}\t{3:g}\t{4:g}\t{5:g}\n'.format(d['simulation_id'],
-                                                                      d['p_value'],
-                                                                      d['searched_area'],
-                                                                      d['area50'],
-                                                                      d['area75'],
-                                                                      d['area90']))
+        out.write('\t'.join([d['simulation_id']] +
+                            ['{0:g}'.format(d[f]) for f in data.dtype.names[1:]]) + '\n')
 if not options.noinj:
     ks_stat, ks_p = ss.kstest(data['p_value'], lambda x: x)
 
@@ -75,9 +139,10 @@ if not options.noinj:
     pp.xlabel(r'Searched Area (deg$^2$)')
     pp.savefig(os.path.join(options.prefix, 'searched-area.pdf'))
 pp.clf()
-pu.plot_cumulative_distribution(data['area50'], label=str('50\%'))
-pu.plot_cumulative_distribution(data['area75'], label=str('75\%'))
-pu.plot_cumulative_distribution(data['area90'], label=str('90\%'))    
+for cl in options.plot_cls.split(','):
+    field = column_field('area({0:s})'.format(cl))
+    if field in data.dtype.names:
+        pu.plot_cumulative_distribution(data[field], label=str(cl + '\%'))
 pp.xscale('log')
 pp.xlabel(r'Credible Area (deg$^2$)')
 pp.legend(loc='upper left')
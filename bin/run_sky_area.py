@@ -13,6 +13,7 @@ import lalinference.cmap
 from lalinference import fits
 from lalinference import plot
 import healpy as hp
+import logging
 import numpy as np
 import os
 import pickle
@@ -26,11 +27,14 @@ class LIGOLWContentHandler(ligolw.LIGOLWContentHandler):
 lsctables.use_in(LIGOLWContentHandler)
 
 def plot_skymap(output, skypost, pixresol=np.pi/180.0, nest=True,inj=None, fast=True):
+    # Resolve the posterior, but no finer than pixresol.
     nside = 1
     while hp.nside2resol(nside) > pixresol:
         nside *= 2
+    nside = min(nside, skypost.auto_nside())
 
-    pix_post = skypost.as_healpix(nside, nest=nest, fast=fast)
+    # Single precision is plenty for display.
+    pix_post = skypost.as_healpix(nside, nest=nest, fast=fast, dtype=np.float32)
 
     fig = pp.figure(frameon=False)
     ax = pp.subplot(111, projection='astro mollweide')
@@ -57,24 +61,42 @@ def plot_assign(output, skypost):
 
     pp.savefig(output)
 
-def save_areas(output, skypost, sim_id, ra, dec, cls=[0.5, 0.75, 0.9], fast=True):
+def save_areas(output, skypost, sim_id, ra, dec, cls=[0.5, 0.75, 0.9], fast=True, direct=False):
+    """Writes the p-value and searched area of the injection, and the
+    credible areas at each of the levels in ``cls``, to ``output``.
+    All the areas are computed together, from a single evaluation of
+    the posterior, so ``cls`` may be a dense vector of levels.  The
+    column for credible level ``cl`` is headed ``area(100*cl)``.  If
+    ``direct``, the areas are estimated by Monte Carlo from draws from
+    the posterior where that is accurate enough, and integrated over
+    the sky otherwise (see ``ClusteredSkyKDEPosterior.sky_area_direct``).
+
+    """
+
+    def sky_area(levels):
+        if direct:
+            areas, errors = skypost.sky_area_direct(levels, fast=fast)
+            logging.info('direct sky areas %s +/- %s sr', areas, errors)
+            return areas
+        else:
+            return skypost.sky_area(levels, fast=fast)
 
     if sim_id is None or ra is None or dec is None:
         p_value = 0.0
         levels = cls
-        areas = skypost.sky_area(cls, fast=fast)
+        areas = sky_area(cls)
         areas = np.concatenate((areas, [0.0]))
     else:
         p_value = skypost.p_values(np.array([[ra,dec]]))[0]
         levels = np.concatenate((cls, [p_value]))
-        areas = skypost.sky_area(levels, fast=fast)
+        areas = sky_area(levels)
 
     rad2deg = 180.0/np.pi
 
     # Final areas in degrees
     areas = areas*rad2deg*rad2deg
 
-    str_cls = ['area({0:d})'.format(int(round(100.0*cl))) for cl in cls]
+    str_cls = ['area({0:g})'.format(100.0*cl) for cl in cls]
 
     with open(output, 'w') as out:
         print(
@@ -101,35 +123,63 @@ if __name__ == '__main__':
 
     parser.add_option('--maxpts', type='int', help='maximum number of posterior points to use')
 
+    parser.add_option('--nproc', type='int', default=1, help='number of processes evaluating the posterior [default: %default]')
+
+    parser.add_option('--prune-tol', type='float', help='skip clusters where their kernels are below this fraction of their peak (faster for many clusters; default exact)')
+
     parser.add_option('--trials', type='int', default=50, help='maximum number of trials to build sky posterior [default: %default]')
 
     parser.add_option('--slowskyarea', default=False, action='store_true', help='use a much slower but robust sky area algorithm')
 
+    parser.add_option('--directskyarea', default=False, action='store_true', help='estimate sky areas by Monte Carlo from draws from the posterior (fastest; no sky grid)')
+
     parser.add_option('--slowsmoothskymaps', default=False, action='store_true', help='use a faster algorithm for producing skymaps (that are "blocky")')
 
     parser.add_option('--enable-distance-map', action='store_true', default=False, help='enable output of healpy map of distance mean and s.d.')
 
-    parser.add_option('--nside', type=int, default=512, help='HEALPix resolution [default: %default]')
+    parser.add_option('--nside', type=int, help='HEALPix resolution [default: chosen to resolve the posterior, up to --max-nside]')
+
+    parser.add_option('--max-nside', type=int, default=2048, help='largest HEALPix resolution to choose for the FITS map when --nside is not given [default: %default]')
+
+    parser.add_option('--map-rtol', type='float', help='with --slowsmoothskymaps, approximate the FITS map to this accuracy relative to its peak (much faster at high --nside)')
+
+    parser.add_option('--single-precision', action='store_true', default=False, help='evaluate the FITS sky map in single precision (faster, but zero far from the samples; areas are always double precision)')
 
     parser.add_option('--objid', help='event ID to store in FITS header')
 
     parser.add_option('--seed', type=int, default=None, help='use specified random seed')
 
+    parser.add_option('--verbose', action='store_true', default=False, help='log the progress of the clustering and sky area calculations in detail')
+
+    parser.add_option('--cls', default='0.5,0.75,0.9', help='comma-separated credible levels at which to compute areas [default: %default]')
+
+    parser.add_option('--ncls', type=int, default=None, help='instead of --cls, compute areas at the NCLS-1 evenly-spaced levels 1/NCLS, 2/NCLS, ...')
+
     (args, remaining) = parser.parse_args()
 
-    if args.seed is not None:
-        np.random.seed(args.seed)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.ncls is not None:
+        cls = np.arange(1, args.ncls)/float(args.ncls)
+    else:
+        cls = np.array([float(cl) for cl in args.cls.split(',')])
+
+    # All random choices are drawn from this state, so that runs with
+    # the same seed are reproducible.
+    random_state = np.random.RandomState(args.seed)
 
     data = np.recfromtxt(args.samples, names=True)
     pts = np.column_stack((data['ra'], data['dec']))
 
     if args.maxpts is not None:
-        pts = np.random.permutation(pts)[:args.maxpts, :]
+        pts = random_state.permutation(pts)[:args.maxpts, :]
 
     if args.loadpost is None:
         for i in range(args.trials):
             try:
-                skypost = sac.ClusteredSkyKDEPosterior(pts)
+                skypost = sac.ClusteredSkyKDEPosterior(pts, random_state=random_state,
+                                                       n_jobs=args.nproc,
+                                                       prune_tol=args.prune_tol)
                 break
             except:
                 skypost = None
@@ -140,6 +190,8 @@ if __name__ == '__main__':
     else:
         with open(args.loadpost, 'r') as inp:
             skypost = pickle.load(inp)
+        skypost.n_jobs = args.nproc
+        skypost.prune_tol = args.prune_tol
 
     try:
         os.makedirs(args.outdir)
@@ -188,17 +240,30 @@ if __name__ == '__main__':
     if injpos is not None:
         save_areas(os.path.join(args.outdir, 'areas.dat'),
                    skypost,
-                   injpos['id'], injpos['ra'], injpos['dec'], fast=not(args.slowskyarea))
+                   injpos['id'], injpos['ra'], injpos['dec'], cls=cls, fast=not(args.slowskyarea),
+                   direct=args.directskyarea)
 
     else:
         save_areas(os.path.join(args.outdir, 'areas.dat'),
                    skypost,
-                   None, None, None, fast=not(args.slowskyarea))
+                   None, None, None, cls=cls, fast=not(args.slowskyarea),
+                   direct=args.directskyarea)
 
     fits_nest = True
 
+    if args.nside is not None:
+        nside = args.nside
+    else:
+        nside = skypost.auto_nside()
+        if nside > args.max_nside:
+            logging.info('posterior resolved at nside = %d; capping at --max-nside', nside)
+            nside = args.max_nside
+    logging.info('writing sky maps at nside = %d', nside)
+
     if not args.enable_distance_map:
-        hpmap = skypost.as_healpix(args.nside, nest=fits_nest, fast=not(args.slowsmoothskymaps))
+        hpmap = skypost.as_healpix(nside, nest=fits_nest, fast=not(args.slowsmoothskymaps),
+                                   dtype=np.float32 if args.single_precision else None,
+                                   rtol=args.map_rtol)
     else:
         print('Constructing 3D clustered posterior.')
         try:
@@ -207,14 +272,16 @@ if __name__ == '__main__':
             print("ERROR, cannot use skypost3d with LIB output. Exiting..\n")
             import sys
             sys.exit(1)
-        skypost3d = sac.Clustered3DKDEPosterior(xyz)
+        skypost3d = sac.Clustered3DKDEPosterior(xyz, random_state=random_state,
+                                                n_jobs=args.nproc,
+                                                prune_tol=args.prune_tol)
 
         print('pickling ...')
         with open(os.path.join(args.outdir, 'skypost3d.obj'), 'w') as out:
             pickle.dump(skypost3d, out)
 
         print('Producing distance map')
-        hpmap = skypost3d.as_healpix(args.nside, nest=fits_nest)
+        hpmap = skypost3d.as_healpix(nside, nest=fits_nest)
     names=data.dtype.names 
     if 'time' in names:
       gps_time=data['time'].mean()
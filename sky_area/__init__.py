@@ -1 +1 @@
-__all__ = ['search', 'sky_area_clustering']
+__all__ = ['search', 'sky_area_clustering', 'tiled_search']
@@ -13,7 +13,53 @@ def _find_nside(beam, pix_per_beam):
 
     return nside
 
-def search_map(ras, decs, beam, nest=True, pix_per_beam=10):
+# Direct smoothing costs roughly this many times less per (pixel,
+# source) pair than a full-sky smoothing costs per nside**3.
+_DIRECT_COST_RATIO = 4
+
+def _beam_sigma(beam):
+    return beam/(2.0*np.sqrt(2.0*np.log(2.0)))
+
+def _sky_patch(thetas, ras, pad):
+    """Returns ``(centre, radius)`` of a disc on the sky containing all
+    the given points, padded by ``pad`` radians, or ``None`` if no
+    such disc smaller than the whole sky is found.
+
+    """
+    vecs = hp.ang2vec(thetas, ras)
+    centre = np.sum(vecs, axis=0)
+    norm = np.sqrt(np.dot(centre, centre))
+    if norm == 0.0:
+        return None
+    centre = centre / norm
+
+    radius = np.arccos(np.clip(np.min(np.dot(vecs, centre)), -1.0, 1.0)) + pad
+    if radius >= np.pi:
+        return None
+
+    return centre, radius
+
+def _direct_smoothing(nside, src, counts, beam, patch, nest=True, nmax=1<<22):
+    """Returns the map of ``counts`` in pixels ``src`` convolved with a
+    Gaussian beam, evaluated by direct summation over the pixels in
+    ``patch`` (the map is zero elsewhere).
+
+    """
+    sigma = _beam_sigma(beam)
+    src_vecs = np.array(hp.pix2vec(nside, src, nest=nest))
+
+    smap = np.zeros(hp.nside2npix(nside))
+    step = max(1, nmax // src.shape[0])
+    for low in range(0, patch.shape[0], step):
+        pix = patch[low:low+step]
+        vecs = np.column_stack(hp.pix2vec(nside, pix, nest=nest))
+        # exp((cos(theta) - 1)/sigma^2) ~ exp(-theta^2/(2 sigma^2))
+        kernel = np.exp((np.dot(vecs, src_vecs) - 1.0)/(sigma*sigma))
+        smap[pix] = np.dot(kernel, counts)
+
+    return smap
+
+def search_map(ras, decs, beam, nest=True, pix_per_beam=10, method='auto'):
     """Returns a healpix map optimised for searching on the sky.  It
     represents the Gaussian-beam convolved posterior.
 
@@ -29,31 +75,102 @@ def search_map(ras, decs, beam, nest=True, pix_per_beam=10):
     :param pix_per_beam: The number of pixels in the output map per
       beam (default 10).
 
+    :param method: How to convolve with the beam.  ``'harmonic'``
+      smooths the binned samples with a full-sky spherical-harmonic
+      transform.  ``'direct'`` sums the beam directly over the pixels
+      of a disc enclosing the samples (padded by five beam widths),
+      which is much cheaper for compact posteriors.  ``'auto'``
+      (default) chooses ``'direct'`` when its estimated cost is lower,
+      so falls back to ``'harmonic'`` when the samples spread over a
+      large fraction of the sky.
+
     :return: An array representing the posterior convolved with a
       Gaussian beam of the given size.  The array is normalised as a
       probability density per square degree.
 
     """
 
-    nside = _find_nside(beam, pix_per_beam)
+    return search_maps(ras, decs, [beam], nest=nest, pix_per_beam=pix_per_beam,
+                       method=method)[0]
+
+def search_maps(ras, decs, beams, nest=True, pix_per_beam=10, method='auto'):
+    """Returns search maps (see :func:`search_map`) for several beams at
+    once.  The samples are binned once, at a resolution with
+    ``pix_per_beam`` pixels across the smallest beam, and (for the
+    harmonic method) a single forward spherical-harmonic transform is
+    shared by all the beams; only the beam window and inverse
+    transform are repeated for each beam.
+
+    :param ras: RA posterior samples.
+
+    :param decs: Corresponding DEC samples.
+
+    :param beams: A sequence of beam FWHMs in radians.
+
+    :param nest: Whether to output the maps in nested (default) or
+      ring pixel ordering.
+
+    :param pix_per_beam: The number of pixels per beam for the
+      smallest beam (default 10).
+
+    :param method: ``'auto'``, ``'direct'`` or ``'harmonic'``; see
+      :func:`search_map`.
+
+    :return: A list of maps, one per beam, each normalised as a
+      probability density per square degree.
+
+    """
+
+    beams = np.atleast_1d(beams)
+    nside = _find_nside(np.min(beams), pix_per_beam)
 
     thetas = np.pi/2.0 - decs
 
-    # Create the map in ring coordinates first.
-    hmap = np.bincount(hp.ang2pix(nside, thetas, ras))
-    if hmap.shape[0] < hp.nside2npix(nside):
-        hmap = np.concatenate((hmap, np.zeros(hp.nside2npix(nside)-hmap.shape[0])))
+    if method not in ('auto', 'direct', 'harmonic'):
+        raise ValueError('unknown method: {0!r}'.format(method))
 
-    hmap = hmap / float(thetas.shape[0]) / hp.nside2pixarea(nside)
+    if method != 'harmonic':
+        src, counts = np.unique(hp.ang2pix(nside, thetas, ras, nest=nest),
+                                return_counts=True)
+        disc = _sky_patch(thetas, ras, 5.0*_beam_sigma(np.max(beams)))
 
-    chmap = hps.smoothing(hmap, fwhm=beam, pol=False)
+        if disc is None:
+            patch = np.arange(hp.nside2npix(nside))
+        else:
+            patch = hp.query_disc(nside, disc[0], disc[1], nest=nest)
 
-    if nest:
-        chmap = hp.reorder(chmap, r2n=True)
+        if method == 'auto':
+            if patch.shape[0]*src.shape[0] < _DIRECT_COST_RATIO*nside**3:
+                method = 'direct'
+            else:
+                method = 'harmonic'
 
-    norm = np.sum(chmap) * hp.nside2pixarea(nside, degrees=True)
-    
-    return chmap / norm
+    if method == 'direct':
+        chmaps = [_direct_smoothing(nside, src, counts, beam, patch, nest=nest)
+                  for beam in beams]
+    else:
+        # Create the map in ring coordinates first.
+        hmap = np.bincount(hp.ang2pix(nside, thetas, ras))
+        if hmap.shape[0] < hp.nside2npix(nside):
+            hmap = np.concatenate((hmap, np.zeros(hp.nside2npix(nside)-hmap.shape[0])))
+
+        hmap = hmap / float(thetas.shape[0]) / hp.nside2pixarea(nside)
+
+        alm = hps.map2alm(hmap, iter=3)
+        lmax = hps.Alm.getlmax(alm.shape[0])
+
+        chmaps = []
+        for beam in beams:
+            chmap = hps.alm2map(hps.almxfl(alm, hps.gauss_beam(beam, lmax=lmax)), nside)
+
+            if nest:
+                chmap = hp.reorder(chmap, r2n=True)
+
+            chmaps.append(chmap)
+
+    pixarea = hp.nside2pixarea(nside, degrees=True)
+
+    return [chmap / (np.sum(chmap) * pixarea) for chmap in chmaps]
 
 def search_map_searched_area_pt(smap, ra, dec, nest=True):
     """Returns the area on the sky required to be imaged in a greedy
@@ -157,3 +274,98 @@ def search_map_credible_level_pt(smap, ra, dec, nest=True):
     ptden = smap[ptidx]
 
     return np.sum(smap[smap >= ptden])
+
+class SearchMapIndex(object):
+    """A search map sorted once into greedy-search order, for answering
+    many searched-area and credible-level queries against the same map
+    with vectorised lookups.  The answers are the same as those of
+    :func:`search_map_searched_area_pt`,
+    :func:`search_map_credible_level_pt` and
+    :func:`search_map_searched_area_cl`.
+
+    """
+
+    def __init__(self, smap, nest=True):
+        """Index the given search map.
+
+        :param smap: The search map (need not be normalised).
+
+        :param nest: ``True`` if the map is in nested order (default).
+
+        """
+        smap = np.atleast_1d(smap)
+        smap = smap / np.sum(smap)
+
+        self._nest = nest
+        self._nside = hp.npix2nside(smap.shape[0])
+        self._pixarea = hp.nside2pixarea(self._nside, degrees=True)
+        self._smap = smap
+
+        # Pixel values from highest to lowest, and the probability
+        # covered after searching each pixel in turn.
+        self._greedy_map = np.sort(smap)[::-1]
+        self._cum_probs = np.cumsum(self._greedy_map)
+
+    @property
+    def nside(self):
+        """The resolution of the indexed map.
+
+        """
+        return self._nside
+
+    @property
+    def nest(self):
+        """``True`` if the indexed map is in nested order.
+
+        """
+        return self._nest
+
+    @property
+    def pixarea(self):
+        """The area of each pixel, in square degrees.
+
+        """
+        return self._pixarea
+
+    @property
+    def cum_probs(self):
+        """The cumulative probability covered after searching each pixel in
+        greedy order.
+
+        """
+        return self._cum_probs
+
+    def _nsearched_pts(self, ras, decs):
+        """Returns the number of pixels searched before (and including) the
+        pixels containing each of the given points.
+
+        """
+        ras = np.atleast_1d(ras)
+        decs = np.atleast_1d(decs)
+
+        ptidx = hp.ang2pix(self.nside, np.pi/2.0 - decs, ras, nest=self.nest)
+
+        return np.searchsorted(-self._greedy_map, -self._smap[ptidx], side='right')
+
+    def searched_area_pts(self, ras, decs):
+        """Returns the area (in square degrees) that must be searched
+        greedily before imaging each of the points ``(ras, decs)``.
+
+        """
+        return self._nsearched_pts(ras, decs)*self.pixarea
+
+    def credible_level_pts(self, ras, decs):
+        """Returns the fraction of the probability covered by a greedy search
+        before imaging each of the points ``(ras, decs)``.
+
+        """
+        return self.cum_probs[self._nsearched_pts(ras, decs) - 1]
+
+    def searched_area_cls(self, cls):
+        """Returns the area (in square degrees) that must be searched
+        greedily to reach each of the credible levels ``cls``.
+
+        """
+        cls = np.atleast_1d(cls)
+
+        return np.searchsorted(self.cum_probs, cls, side='right')*self.pixarea
@@ -1,9 +1,148 @@
-import bisect as bs
+import collections
+import contextlib
+import functools
 import healpy as hp
+import itertools
+import logging
+import multiprocessing as mp
 import numpy as np
 import numpy.linalg as nl
+import os
+import os.path
 import scipy.integrate as si
+import scipy.ndimage as sn
+import scipy.signal as ss
 from scipy.stats import gaussian_kde
+import tempfile
+import timeit
+
+logger = logging.getLogger(__name__)
+
+class StageProfile(object):
+    """Records, for each named stage of a computation, the wall time, the
+    number of calls, the number of k-means iterations, the number of
+    points at which the posterior was evaluated, and the size (in
+    elements) of the largest kernel-evaluation array.
+
+    Wall times are inclusive of any stages nested inside a stage; the
+    counters are attributed to the innermost active stage only.  A
+    stage nested inside another of the same name is not counted again.
+
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._active = []
+
+    def _new_stats(self):
+        return {'wall_time': 0.0,
+                'calls': 0,
+                'kmeans_iterations': 0,
+                'posterior_evaluations': 0,
+                'peak_array_size': 0}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that times the enclosed code as stage ``name``.
+
+        """
+        stats = self._stats.setdefault(name, self._new_stats())
+        if name in self._active:
+            # Already timed by the enclosing stage of the same name.
+            yield stats
+            return
+
+        self._active.append(name)
+        start = timeit.default_timer()
+        try:
+            yield stats
+        finally:
+            stats['wall_time'] += timeit.default_timer() - start
+            stats['calls'] += 1
+            self._active.pop()
+
+    def count(self, key, n):
+        """Adds ``n`` to counter ``key`` of the innermost active stage.
+
+        """
+        if self._active:
+            self._stats[self._active[-1]][key] += n
+
+    def peak(self, key, n):
+        """Raises counter ``key`` of the innermost active stage to at least
+        ``n``.
+
+        """
+        if self._active:
+            stats = self._stats[self._active[-1]]
+            stats[key] = max(stats[key], n)
+
+    def as_dict(self):
+        """Returns a copy of the statistics, as a dictionary of dictionaries
+        keyed by stage name.
+
+        """
+        return dict((name, dict(stats)) for name, stats in self._stats.items())
+
+    def reset(self):
+        """Discards all recorded statistics.
+
+        """
+        self._stats = {}
+
+    def log(self, level=logging.INFO):
+        """Emits the statistics of each stage through the module logger.
+
+        """
+        for name in sorted(self._stats):
+            stats = self._stats[name]
+            logger.log(level, '%s: %.3g s in %d calls, %d k-means iterations, '
+                       '%d posterior evaluations, peak array size %d',
+                       name, stats['wall_time'], stats['calls'],
+                       stats['kmeans_iterations'], stats['posterior_evaluations'],
+                       stats['peak_array_size'])
+
+def _profiled(stage):
+    """Decorator that records calls to a posterior method in
+    ``self.profile`` as stage ``stage``.
+
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profile.stage(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def check_random_state(random_state):
+    """Returns a :class:`numpy.random.RandomState` corresponding to
+    ``random_state``.
+
+    :param random_state: ``None`` (use the global ``numpy.random``
+      state), an integer seed, or a ``RandomState`` instance (returned
+      unchanged).
+
+    """
+    if random_state is None:
+        return np.random.mtrand._rand
+    elif isinstance(random_state, np.random.RandomState):
+        return random_state
+    else:
+        return np.random.RandomState(random_state)
+
+def spawn_random_states(random_state, n):
+    """Returns a list of ``n`` independently-seeded
+    :class:`numpy.random.RandomState` objects derived from
+    ``random_state``, one for each of ``n`` workers or events.  The
+    streams depend only on ``random_state`` and ``n``, so batched
+    computations give the same results whether they are run serially
+    or in parallel.
+
+    """
+    random_state = check_random_state(random_state)
+    seeds = random_state.randint(np.iinfo(np.uint32).max, size=n)
+    return [np.random.RandomState(seed) for seed in seeds]
 
 def km_assign(mus, cov, pts):
     """Implements the assignment step in the k-means algorithm.  Given a
@@ -25,26 +164,33 @@ def km_assign(mus, cov, pts):
 
     return np.argmin(dists, axis=0)
 
-def km_centroids(pts, assign, k):
+def km_centroids(pts, assign, k, weights=None, random_state=None):
     """Implements the centroid-update step of the k-means algorithm.
     Given a set of points, ``pts``, of shape ``(npts, ndim)``, and an
     assignment of each point to a region, ``assign``, and the number
     of means, ``k``, returns an array of shape ``(k, ndim)`` giving
-    the centroid of each region.  
+    the centroid of each region.  If ``weights`` (shape ``(npts,)``)
+    is given, the centroids are weighted means.  Empty regions are
+    re-seeded at a random point drawn using ``random_state`` (see
+    :func:`check_random_state`).
 
     """
+    random_state = check_random_state(random_state)
 
     mus = np.zeros((k, pts.shape[1]))
     for i in range(k):
         sel = assign==i
         if np.sum(sel) > 0:
-            mus[i,:] = np.mean(pts[sel, :], axis=0)
+            if weights is None:
+                mus[i,:] = np.mean(pts[sel, :], axis=0)
+            else:
+                mus[i,:] = np.average(pts[sel, :], axis=0, weights=weights[sel])
         else:
-            mus[i,:] = pts[np.random.randint(pts.shape[0]), :]
+            mus[i,:] = pts[random_state.randint(pts.shape[0]), :]
 
     return mus
 
-def k_means(pts, k):
+def k_means(pts, k, means=None, weights=None, random_state=None):
     """Implements k-means clustering on the set of points.
 
     :param pts: Array of shape ``(npts, ndim)`` giving the points on
@@ -52,29 +198,613 @@ def k_means(pts, k):
 
     :param k: Positive integer giving the number of regions.
 
+    :param means: If not ``None``, a ``(k, ndim)`` array of initial
+      centroids (for example, from a previous clustering).
+      Otherwise, the initial centroids are ``k`` randomly chosen
+      points.
+
+    :param weights: If not ``None``, an array of shape ``(npts,)``
+      giving the weight of each point.
+
+    :param random_state: Source of randomness for the initial and
+      re-seeded centroids (see :func:`check_random_state`).
+
     :return: ``(centroids, assign)``, where ``centroids`` is an ``(k,
       ndim)`` array giving the centroid of each region, and ``assign``
       is a ``(npts,)`` array of integers between 0 (inclusive) and k
       (exclusive) indicating the assignment of each point to a region.
 
+    """
+    mus, assign, niter = _k_means(pts, k, means=means, weights=weights,
+                                  random_state=random_state)
+    return mus, assign
+
+def _k_means(pts, k, means=None, weights=None, random_state=None):
+    """Like :func:`k_means`, but also returns the number of iterations.
+
     """
     assert pts.shape[0] > k, 'must have more points than means'
 
-    cov = np.cov(pts, rowvar=0)
+    random_state = check_random_state(random_state)
 
-    mus = np.random.permutation(pts)[:k, :]
+    cov = np.cov(pts, rowvar=0, aweights=weights)
+
+    if means is None:
+        mus = random_state.permutation(pts)[:k, :]
+    else:
+        mus = np.array(means, dtype=float)
     assign = km_assign(mus, cov, pts)
+    niter = 0
     while True:
         old_mus = mus
         old_assign = assign
 
-        mus = km_centroids(pts, assign, k)
+        mus = km_centroids(pts, assign, k, weights=weights, random_state=random_state)
         assign = km_assign(mus, cov, pts)
+        niter += 1
 
         if np.all(assign == old_assign):
             break
 
-    return mus, assign
+    return mus, assign, niter
+
+# The number of samples whose kernels are summed at a reduced precision
+# before being added to a double-precision total.
+_REDUCED_SUM_RUN = 256
+
+class _ClusterKernels(object):
+    """The Gaussian kernels of all the clusters of a clustered KDE,
+    prepared once for repeated evaluation.
+
+    Each cluster's samples are stored whitened by the Cholesky factor
+    of its inverse kernel covariance, about the cluster centre, so that
+    evaluation is a matrix product per block of points.  The
+    normalisation, the kernel weights and the cluster weight are folded
+    into a single coefficient per sample.
+
+    Optionally, each cluster is only evaluated at the points within a
+    cutoff distance (in whitened coordinates) of the ball containing
+    its samples; see :attr:`prune_tol`.
+
+    Compared with summing the ``gaussian_kde`` of each cluster, this
+    saves the per-call set-up and the distance computation, but not
+    the exponentials, which dominate large evaluations: repeated small
+    queries are about twice as fast, large ones little or no faster
+    (``test/sac_benchmark.py --kernels`` measures both).
+    Only :attr:`prune_tol` or :meth:`binned` reduce the cost of
+    evaluating many points.
+
+    """
+
+    def __init__(self, kdes, weights, nmax=1<<22, prune_tol=None):
+        """Prepare the kernels.
+
+        :param kdes: The ``scipy.stats.gaussian_kde`` of each cluster.
+
+        :param weights: The weight of each cluster.
+
+        :param nmax: The maximum number of kernel values to compute at
+          once.
+
+        :param prune_tol: If not ``None``, the tolerance for skipping
+          distant clusters; see :attr:`prune_tol`.
+
+        """
+        self._nmax = nmax
+        self.prune_tol = prune_tol
+
+        self._centres = []
+        self._whitens = []
+        self._data = []
+        self._half_data_sq = []
+        self._coeffs = []
+        for kde, weight in zip(kdes, weights):
+            whiten = nl.cholesky(kde.inv_cov)
+            centre = np.mean(kde.dataset, axis=1)
+            data = np.dot(kde.dataset.T - centre, whiten)
+
+            if hasattr(kde, 'weights'):
+                kweights = kde.weights
+            else:
+                kweights = np.zeros(data.shape[0]) + 1.0/data.shape[0]
+
+            self._centres.append(centre)
+            self._whitens.append(whiten)
+            self._data.append(data)
+            self._half_data_sq.append(0.5*np.sum(data*data, axis=1))
+            self._coeffs.append(weight*kweights/np.sqrt(nl.det(2.0*np.pi*kde.covariance)))
+
+        self._binned = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The binned grids can be large, and are cheap to rebuild.
+        state['_binned'] = None
+        return state
+
+    @property
+    def nmax(self):
+        """The maximum number of kernel values computed at once.
+
+        """
+        return self._nmax
+
+    @nmax.setter
+    def nmax(self, nmax):
+        self._nmax = nmax
+
+    @property
+    def prune_tol(self):
+        """If not ``None``, clusters are skipped at points where every one of
+        their kernels is below ``prune_tol`` times its peak, so that
+        the error in each cluster's contribution is at most
+        ``prune_tol`` times the largest density it could contribute.
+        If ``None``, every cluster is evaluated at every point.
+
+        """
+        return self._prune_tol
+
+    @prune_tol.setter
+    def prune_tol(self, prune_tol):
+        if prune_tol is not None and not 0.0 < prune_tol < 1.0:
+            raise ValueError('prune_tol must be between 0 and 1')
+        self._prune_tol = prune_tol
+
+    @property
+    def max_n(self):
+        """The largest number of samples in any cluster.
+
+        """
+        return max([d.shape[0] for d in self._data] + [0])
+
+    def block_size(self, npts):
+        """Returns the number of points, out of ``npts``, evaluated at
+        once.
+
+        """
+        return min(npts, max(1, self.nmax // max(self.max_n, 1)))
+
+    def __call__(self, pts, dtype=None):
+        """Returns the weighted sum over clusters of the KDEs at the
+        ``(npts, ndim)`` array ``pts``.
+
+        :param dtype: If not ``None``, the floating-point precision at
+          which to compute the kernels.  The kernels are summed in
+          short runs at that precision, and the runs summed, and the
+          result returned, in double precision.
+
+        """
+        dtype = np.float64 if dtype is None else dtype
+
+        if self.prune_tol is not None:
+            cutoff = np.sqrt(-2.0*np.log(self.prune_tol))
+
+        result = np.zeros(pts.shape[0])
+        step = max(1, self.block_size(pts.shape[0]))
+        for centre, whiten, data, half_data_sq, coeffs in zip(
+                self._centres, self._whitens, self._data, self._half_data_sq, self._coeffs):
+            x = np.dot(pts - centre, whiten)
+
+            if self.prune_tol is not None:
+                # Beyond this distance from the centre, every kernel is
+                # below the cutoff.
+                radius = np.sqrt(2.0*np.max(half_data_sq)) + cutoff
+                near = np.flatnonzero(np.sum(x*x, axis=1) <= radius*radius)
+                if near.shape[0] == 0:
+                    continue
+                x = x[near]
+
+            data = data.astype(dtype, copy=False)
+            half_data_sq = half_data_sq.astype(dtype, copy=False)
+            reduced_coeffs = coeffs.astype(dtype, copy=False)
+
+            x = x.astype(dtype, copy=False)
+            half_x_sq = 0.5*np.sum(x*x, axis=1)
+
+            post = np.zeros(x.shape[0])
+            for low in range(0, x.shape[0], step):
+                high = min(low + step, x.shape[0])
+                energy = np.dot(x[low:high], data.T)
+                np.subtract(half_data_sq, energy, out=energy)
+                energy += half_x_sq[low:high, np.newaxis]
+                # Rounding can make distances very slightly negative.
+                np.maximum(energy, 0.0, out=energy)
+                np.exp(-energy, out=energy)
+                if dtype == np.float64:
+                    post[low:high] = np.dot(energy, coeffs)
+                else:
+                    # Sum short runs of samples at the reduced
+                    # precision, and the runs in double precision,
+                    # rather than copying the whole block to double.
+                    for slow in range(0, energy.shape[1], _REDUCED_SUM_RUN):
+                        shigh = slow + _REDUCED_SUM_RUN
+                        post[low:high] += np.dot(energy[:, slow:shigh],
+                                                 reduced_coeffs[slow:shigh])
+
+            if self.prune_tol is None:
+                result += post
+            else:
+                result[near] += post
+
+        return result
+
+    def binned(self, rtol):
+        """Returns a :class:`_BinnedClusterKernels` approximating these
+        kernels to relative accuracy ``rtol``.  The most recent one is
+        cached.
+
+        """
+        if self._binned is None or self._binned.rtol != rtol:
+            self._binned = _BinnedClusterKernels(self, rtol)
+        return self._binned
+
+class _BinnedClusterKernels(object):
+    """An approximation to :class:`_ClusterKernels` for dense queries.
+
+    Each cluster's whitened samples are linearly binned onto a regular
+    grid, which is convolved with the (unit, in whitened coordinates)
+    Gaussian kernel by FFT; the result is linearly interpolated at the
+    query points.  The grid spacing is ``2*sqrt(rtol)`` and kernels are
+    truncated where they fall below ``rtol`` of their peak, so the
+    error is of order ``rtol`` times the peak density.  The cost of a
+    query is independent of the number of samples.
+
+    """
+
+    def __init__(self, kernels, rtol, max_grid_size=1<<26):
+        """Bin the given kernels.
+
+        :param kernels: The :class:`_ClusterKernels` to approximate.
+
+        :param rtol: The accuracy required, relative to the peak
+          density; ``0 < rtol < 1``.
+
+        :param max_grid_size: The largest grid allowed for a cluster.
+
+        """
+        if not 0.0 < rtol < 1.0:
+            raise ValueError('rtol must be between 0 and 1')
+
+        self._rtol = rtol
+        self._spacing = h = 2.0*np.sqrt(rtol)
+        cutoff = np.sqrt(-2.0*np.log(rtol))
+
+        m = int(np.ceil(cutoff/h))
+        u = h*np.arange(-m, m+1)
+
+        self._centres = kernels._centres
+        self._whitens = kernels._whitens
+        self._lows = []
+        self._grids = []
+        for data, coeffs in zip(kernels._data, kernels._coeffs):
+            ndim = data.shape[1]
+
+            low = np.min(data, axis=0) - (m+1)*h
+            shape = np.ceil((np.max(data, axis=0) + (m+1)*h - low)/h).astype(int) + 1
+            if np.prod(shape) > max_grid_size:
+                raise ValueError('binned KDE grid too large; increase rtol')
+
+            # Linear binning: share each sample between the corners of
+            # its grid cell.
+            x = (data - low)/h
+            i0 = np.floor(x).astype(int)
+            frac = x - i0
+            binned = np.zeros(np.prod(shape))
+            for corner in itertools.product([0, 1], repeat=ndim):
+                corner = np.array(corner)
+                w = coeffs*np.prod(np.where(corner, frac, 1.0 - frac), axis=1)
+                flat = np.ravel_multi_index(tuple((i0 + corner).T), shape)
+                binned += np.bincount(flat, weights=w, minlength=binned.shape[0])
+            binned = binned.reshape(shape)
+
+            kernel = np.exp(-0.5*u*u)
+            for i in range(1, ndim):
+                kernel = np.multiply.outer(kernel, np.exp(-0.5*u*u))
+
+            self._lows.append(low)
+            self._grids.append(ss.fftconvolve(binned, kernel, mode='same'))
+
+    @property
+    def rtol(self):
+        """The accuracy of the approximation, relative to the peak density.
+
+        """
+        return self._rtol
+
+    def __call__(self, pts, dtype=None):
+        """Returns the approximate weighted sum over clusters of the KDEs at
+        the ``(npts, ndim)`` array ``pts``.  ``dtype`` is ignored.
+
+        """
+        h = self._spacing
+
+        result = np.zeros(pts.shape[0])
+        for centre, whiten, low, grid in zip(self._centres, self._whitens,
+                                             self._lows, self._grids):
+            x = (np.dot(pts - centre, whiten) - low)/h
+            inside = np.all((x >= 0) & (x <= np.array(grid.shape) - 1), axis=1)
+            result[inside] += sn.map_coordinates(grid, x[inside].T, order=1)
+
+        return result
+
+# In a worker process, the kernels it evaluates.  They are handed to
+# the pool's initializer, so forked workers inherit them rather than
+# receiving a pickled copy; the parent's value is never set.
+_forked_kernels = None
+
+def _set_forked_kernels(kernels):
+    global _forked_kernels
+    _forked_kernels = kernels
+
+def _forked_evaluate(args):
+    pts, dtype = args
+    return _forked_kernels(pts, dtype=dtype)
+
+class _WorkerPool(object):
+    """A pool of ``n_jobs`` forked worker processes evaluating kernels.
+    The workers are only forked when first needed, and are re-forked
+    only if asked to evaluate different kernels, so one pool can serve
+    every chunk of an evaluation.  Use it as a context manager, or call
+    :meth:`close`, to shut the workers down.
+
+    """
+
+    def __init__(self, n_jobs):
+        self._n_jobs = n_jobs
+        self._pool = None
+        self._kernels = None
+
+    def evaluate(self, kernels, pts, dtype=None):
+        """Evaluates ``kernels(pts, dtype=dtype)`` in chunks across the
+        workers.
+
+        """
+        if self._pool is None or kernels is not self._kernels:
+            self.close()
+            self._pool = mp.Pool(self._n_jobs, initializer=_set_forked_kernels,
+                                 initargs=(kernels,))
+            self._kernels = kernels
+
+        chunks = np.array_split(pts, 4*self._n_jobs)
+        return np.concatenate(self._pool.map(_forked_evaluate, [(c, dtype) for c in chunks]))
+
+    def close(self):
+        """Shuts down the workers, if any.
+
+        """
+        if self._pool is not None:
+            pool, self._pool, self._kernels = self._pool, None, None
+            pool.close()
+            pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class PixelCentreCache(object):
+    """A size-bounded, least-recently-used cache of the centres of the
+    pixels of healpix maps, in ``(ra, sin(dec))`` coordinates.
+
+    If a ``directory`` is set, arrays are saved there on first use and
+    thereafter memory-mapped from disk; these do not count towards
+    ``max_bytes``.  The arrays returned are read-only.
+
+    """
+
+    def __init__(self, max_bytes=1<<27, directory=None):
+        """Create an empty cache.
+
+        :param max_bytes: The largest total size of the in-memory
+          arrays kept.
+
+        :param directory: If given, a directory in which to store, and
+          from which to memory-map, the arrays.
+
+        """
+        self._max_bytes = max_bytes
+        self._directory = directory
+        self._entries = collections.OrderedDict()
+
+    @property
+    def max_bytes(self):
+        """The largest total size of the in-memory arrays kept.
+
+        """
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._evict()
+
+    @property
+    def directory(self):
+        """The directory from which arrays are memory-mapped, or ``None``.
+
+        """
+        return self._directory
+
+    @directory.setter
+    def directory(self, directory):
+        self._directory = directory
+        self.clear()
+
+    @property
+    def nbytes(self):
+        """The total size of the in-memory arrays in the cache.
+
+        """
+        return sum(a.nbytes for a in self._entries.values()
+                   if not isinstance(a, np.memmap))
+
+    def clear(self):
+        """Empty the cache.
+
+        """
+        self._entries.clear()
+
+    def __call__(self, nside, nest=True):
+        """Returns the ``(npix, 2)`` array of the ``(ra, sin(dec))`` of
+        the centre of each pixel at resolution ``nside``, in nested
+        (default) or ring order.
+
+        """
+        key = (nside, nest)
+        if key in self._entries:
+            pts = self._entries.pop(key)
+        elif self.directory is not None:
+            pts = self._load(nside, nest)
+        else:
+            pts = self._compute(nside, nest)
+
+        if isinstance(pts, np.memmap) or pts.nbytes <= self.max_bytes:
+            self._entries[key] = pts
+            self._evict()
+
+        return pts
+
+    def centres(self, nside, low, high, nest=True):
+        """Returns the centres of pixels ``low`` to ``high`` at
+        resolution ``nside``, as :meth:`__call__` would.
+
+        The full array is cached only if it can be kept (it fits in
+        ``max_bytes``, or is memory-mapped); otherwise just the
+        requested range is computed, so that callers working through
+        a large map in chunks never hold all of it at once.
+
+        """
+        if self.directory is not None or 16*hp.nside2npix(nside) <= self.max_bytes:
+            return self(nside, nest=nest)[low:high]
+        else:
+            return self._compute(nside, nest, low, high)
+
+    def _compute(self, nside, nest, low=0, high=None):
+        if high is None:
+            high = hp.nside2npix(nside)
+        thetas, phis = hp.pix2ang(nside, np.arange(low, high), nest=nest)
+        pts = np.column_stack((phis, np.cos(thetas)))
+        pts.setflags(write=False)
+        return pts
+
+    def _load(self, nside, nest):
+        path = os.path.join(self.directory, 'pixel_centres_{0:d}_{1:s}.npy'.format(
+            nside, 'nest' if nest else 'ring'))
+
+        if not os.path.exists(path):
+            # Write to a temporary file and rename, so that concurrent
+            # processes never see a partial file.
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.npy')
+            with os.fdopen(fd, 'wb') as out:
+                np.save(out, self._compute(nside, nest))
+            os.rename(tmp_path, path)
+
+        return np.load(path, mmap_mode='r')
+
+    def _evict(self):
+        nbytes = self.nbytes
+        while nbytes > self.max_bytes:
+            for key, pts in self._entries.items():
+                if not isinstance(pts, np.memmap):
+                    del self._entries[key]
+                    nbytes -= pts.nbytes
+                    break
+
+pixel_centres = PixelCentreCache()
+"""The process-wide :class:`PixelCentreCache` used by the map and area
+routines.
+
+"""
+
+def _warm_start_means(warm_start):
+    """Returns the centroids to warm-start from, given either a posterior
+    object or an array of means (or ``None``).
+
+    """
+    if warm_start is None:
+        return None
+    elif isinstance(warm_start, ClusteredSkyKDEPosterior):
+        return np.atleast_2d(warm_start.means)
+    else:
+        return np.atleast_2d(np.asarray(warm_start, dtype=float))
+
+def _split_pts(pts, sample_weights, random_state):
+    """Randomly divides ``pts`` (and the corresponding
+    ``sample_weights``, if any) into two independent halves, returning
+    ``(kde_pts, ranking_pts, kde_weights, ranking_weights)``.
+
+    """
+    perm = random_state.permutation(pts.shape[0])
+    ppts = pts[perm]
+
+    if sample_weights is None:
+        return ppts[::2], ppts[1::2], None, None
+    else:
+        pweights = np.asarray(sample_weights, dtype=float)[perm]
+        return ppts[::2], ppts[1::2], pweights[::2], pweights[1::2]
+
+def _log_post_moments(posts, weights):
+    """Returns the (weighted) mean of ``log(posts)`` and the variance
+    of that mean, using the effective sample size for weighted
+    samples.
+
+    """
+    log_posts = np.log(posts)
+    if weights is None:
+        n = log_posts.shape[0]
+        mean = np.mean(log_posts)
+        var = np.var(log_posts)
+    else:
+        n = np.sum(weights)**2/np.sum(weights*weights)
+        mean = np.average(log_posts, weights=weights)
+        var = np.average((log_posts - mean)**2, weights=weights)
+    return mean, var/n
+
+def _direct_levels(posts, weights, cls):
+    """Returns the posterior levels bounding the credible regions ``cls``,
+    given the posterior values ``posts`` at (optionally weighted)
+    posterior samples, and whether each region is the whole sky.
+
+    """
+    n = posts.shape[0]
+    if weights is None:
+        idxs = np.array([int(round(cl*n)) for cl in cls])
+        missed = idxs >= n
+        kth = n - 1 - np.minimum(idxs, n-1)
+        levels = np.partition(posts, kth)[kth]
+    else:
+        order = np.argsort(posts)[::-1]
+        sorted_weights = weights[order]
+        # Place each sample at the middle of its weight, so that equal
+        # weights reproduce the unweighted round(cl*n) above.
+        mid_weights = np.cumsum(sorted_weights) - 0.5*sorted_weights
+        idxs = np.searchsorted(mid_weights/np.sum(weights), cls, side='right')
+        missed = (idxs >= n) | (np.asarray(cls) >= 1.0)
+        levels = posts[order][np.minimum(idxs, n-1)]
+
+    return levels, missed
+
+def _direct_areas(levels, missed, draw_posts):
+    """Returns the importance-sampling estimates of the areas where the
+    posterior exceeds ``levels`` (the whole sky where ``missed``),
+    given the posterior values ``draw_posts`` at points drawn from the
+    posterior density itself.
+
+    """
+    # Draws where the density underflows to zero weigh in as the whole
+    # sky.
+    with np.errstate(divide='ignore'):
+        inv_posts = 1.0/draw_posts
+    areas = np.array([np.sum(inv_posts[draw_posts >= level]) for level in levels])
+    areas = areas/draw_posts.shape[0]
+
+    # No region can be larger than the sky, however few tail draws the
+    # estimate rests on.
+    areas = np.minimum(areas, 4.0*np.pi)
+    areas[missed] = 4.0*np.pi
+
+    return areas
 
 class ClusteredSkyKDEPosterior(object):
     r"""Represents a kernel-density estimate of a sky-position PDF that has
@@ -90,7 +820,9 @@ class ClusteredSkyKDEPosterior(object):
     where :math:`C_i` is the set of points belonging to cluster
     :math:`i`, :math:`N_i` is the number of points in this cluster,
     :math:`\Sigma_i` is the optimally-converging KDE covariance
-    associated to cluster :math:`i`.
+    associated to cluster :math:`i`.  If the samples carry weights,
+    then :math:`N_i/N` is the fraction of the total weight in cluster
+    :math:`i` and each kernel in :math:`C_i` is weighted accordingly.
 
     The number of clusters, :math:`k` is chosen to maximize the `BIC
     <http://en.wikipedia.org/wiki/Bayesian_information_criterion>`_
@@ -111,7 +843,14 @@ class ClusteredSkyKDEPosterior(object):
     
     """
 
-    def __init__(self, pts, ntrials=5, means=None, assign=None, acc=1e-2):
+    # The least work, in kernel evaluations, worth sharing between
+    # processes.
+    _min_parallel_work = 1<<24
+
+    def __init__(self, pts, ntrials=5, means=None, assign=None, acc=1e-2,
+                 warm_start=None, sample_weights=None, max_cluster_pts=None,
+                 random_state=None, progress=None, n_jobs=1, max_memory=1<<24,
+                 prune_tol=None):
         """Set up the posterior with the given RA-DEC points.
 
         :param pts: The sky points, in RA-DEC coordinates.
@@ -132,23 +871,76 @@ class ClusteredSkyKDEPosterior(object):
         :param acc: The (relative) accuracy with which to compute sky
           areas.
 
+        :param warm_start: If not ``None``, a previous posterior (or
+          the ``means`` array of one, in :math:`(\alpha, \sin\delta)`
+          coordinates) used to warm-start the clustering.  The search
+          over k begins at the previous number of clusters, and
+          k-means is initialised from the previous centroids rather
+          than from random points.  Ignored if ``means`` and
+          ``assign`` are given.
+
+        :param sample_weights: If not ``None``, an array giving the
+          weight of each sample in ``pts`` (for example, the
+          importance weights of a nested-sampling run).  The
+          clustering, KDEs, BIC and credible levels all account for
+          the weights, so weighted samples need not be resampled to
+          equal weight first.
+
+        :param max_cluster_pts: If not ``None``, and there are more KDE
+          points than this, the search over k and the selection among
+          trials are performed on a random subsample of this many KDE
+          points.  The chosen clustering is then applied to all the
+          KDE points with a single final assignment and KDE build.
+          The number of points actually used is reported by
+          ``self.clustering_npts``.
+
+        :param random_state: The source of randomness for the
+          KDE/ranking split, the k-means initialisation and all
+          subsequent random choices: ``None`` (the global
+          ``numpy.random`` state), an integer seed, or a
+          :class:`numpy.random.RandomState`.  Give each concurrent
+          posterior its own state (see :func:`spawn_random_states`)
+          for reproducible parallel runs.
+
+        :param progress: If not ``None``, a callable invoked as
+          ``progress(stage, info)`` as long stages proceed; see
+          ``self.progress``.
+
+        :param n_jobs: The number of processes among which to share
+          large posterior evaluations; see ``self.n_jobs``.
+
+        :param max_memory: The approximate memory budget, in bytes,
+          for evaluating the posterior; see ``self.max_memory``.
+
+        :param prune_tol: If not ``None``, skip clusters at points far
+          from them, to this tolerance; see ``self.prune_tol``.
+
         """
         self._acc = acc
+        self._profile = StageProfile()
+        self._progress = progress
+        self._n_jobs = n_jobs
+        self._workers = None
+        self._max_memory = max_memory
+        self._prune_tol = prune_tol
 
         pts = pts.copy()
         pts[:,1] = np.sin(pts[:,1])
         self._pts = pts
 
-        ppts = np.random.permutation(pts)
+        self._random_state = check_random_state(random_state)
 
-        self._kde_pts = ppts[::2]
-        self._ranking_pts = ppts[1::2]
+        self._kde_pts, self._ranking_pts, self._kde_weights, self._ranking_weights = \
+            _split_pts(pts, sample_weights, self.random_state)
         self._ntrials = ntrials
+        self._max_cluster_pts = max_cluster_pts
 
         if means is None or assign is None:
-            self._set_up_optimal_k()
+            self._set_up_clustering(_warm_start_means(warm_start))
         else:
-            self._set_up_kmeans(means.shape[0], means, assign)
+            self._clustering_npts = self.kde_pts.shape[0]
+            with self.profile.stage('clustering'):
+                self._set_up_kmeans(means.shape[0], means, assign)
 
         self._set_up_greedy_order()
         
@@ -163,6 +955,85 @@ class ClusteredSkyKDEPosterior(object):
     def acc(self, a):
         self._acc = a
 
+    @property
+    def profile(self):
+        """A :class:`StageProfile` recording the time and work spent in each
+        stage: ``'clustering'`` (including the nested ``'bic'``),
+        ``'greedy'`` ordering, adaptive ``'grid'`` building, ``'map'``
+        painting, ``'area'`` integration and ``'update'``.  Use
+        ``self.profile.as_dict()`` to retrieve the statistics and
+        ``self.profile.log()`` to emit them through :mod:`logging`.
+
+        """
+        return self._profile
+
+    @property
+    def progress(self):
+        """Callback (or ``None``) invoked as ``progress(stage, info)`` during
+        long stages.  For ``stage == 'clustering'``, ``info`` has keys
+        ``k``, ``bic`` and ``done``, plus ``trial`` and ``ntrials``
+        for each k-means trial; ``done`` is ``True`` once the best k
+        is found.  For ``stage == 'area'``, ``info`` has keys
+        ``nside``, ``nside_max`` and ``areas`` for each resolution
+        tried.  The callback is not pickled with the posterior.
+
+        """
+        return self._progress
+
+    @progress.setter
+    def progress(self, progress):
+        self._progress = progress
+
+    def _report_progress(self, stage, **info):
+        if self.progress is not None:
+            self.progress(stage, info)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_progress'] = None
+        state['_workers'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Posteriors pickled by older versions.
+        if '_profile' not in state:
+            self._profile = StageProfile()
+        if '_progress' not in state:
+            self._progress = None
+        if '_random_state' not in state:
+            self._random_state = check_random_state(None)
+        if '_kde_weights' not in state:
+            self._kde_weights = None
+        if '_ranking_weights' not in state:
+            self._ranking_weights = None
+        if '_max_cluster_pts' not in state:
+            self._max_cluster_pts = None
+        if '_clustering_npts' not in state:
+            self._clustering_npts = self._kde_pts.shape[0]
+        if '_max_memory' not in state:
+            self._max_memory = 1<<24
+        if '_prune_tol' not in state:
+            self._prune_tol = None
+        if '_kernels' not in state:
+            self._kernels = _ClusterKernels(self.kdes, self.weights,
+                                            nmax=self._kernel_nmax(),
+                                            prune_tol=self.prune_tol)
+        if '_n_jobs' not in state:
+            self._n_jobs = 1
+        if '_workers' not in state:
+            self._workers = None
+        if '_ranking_posteriors' not in state:
+            self._ranking_posteriors = np.empty_like(self._greedy_posteriors)
+            self._ranking_posteriors[self._greedy_order] = self._greedy_posteriors
+
+    @property
+    def random_state(self):
+        """The :class:`numpy.random.RandomState` used for all random choices.
+
+        """
+        return self._random_state
+
     @property
     def ntrials(self):
         """Returns the number of trials at each k over which the cluster
@@ -193,6 +1064,125 @@ class ClusteredSkyKDEPosterior(object):
         """
         return self._ranking_pts
 
+    @property
+    def kde_weights(self):
+        """Returns the sample weights of ``self.kde_pts``, or ``None`` if the
+        samples are unweighted.
+
+        """
+        return self._kde_weights
+
+    @property
+    def ranking_weights(self):
+        """Returns the sample weights of ``self.ranking_pts``, or ``None`` if
+        the samples are unweighted.
+
+        """
+        return self._ranking_weights
+
+    @property
+    def n_jobs(self):
+        """The number of processes among which large posterior evaluations
+        (maps, areas, BIC, ranking) are shared.  One pool of workers is
+        forked for each evaluation, and inherits the kernels from the
+        parent, so this only works where ``multiprocessing`` starts
+        processes with ``fork`` (not on Windows); elsewhere, use the
+        default of 1.
+
+        """
+        return self._n_jobs
+
+    @n_jobs.setter
+    def n_jobs(self, n_jobs):
+        self._n_jobs = n_jobs
+
+    @contextlib.contextmanager
+    def _shared_workers(self):
+        """Context manager within which every parallel evaluation of the
+        posterior shares one pool of workers.  Nested uses share the
+        outermost pool.
+
+        """
+        if self._workers is not None:
+            yield
+            return
+
+        self._workers = _WorkerPool(self.n_jobs)
+        try:
+            yield
+        finally:
+            workers, self._workers = self._workers, None
+            workers.close()
+
+    @property
+    def max_memory(self):
+        """The approximate memory, in bytes, to use for the temporary arrays
+        in an evaluation of the posterior.  Larger sets of points are
+        evaluated in chunks, so any number of points can be evaluated
+        in bounded memory.  (Each worker, if ``self.n_jobs > 1``, may
+        use up to this much.)
+
+        The default, 16 MB, was chosen by measurement: budgets of 64 MB
+        and more were 15-20% slower for maps, areas and large
+        evaluations alike, and raised the peak memory in proportion,
+        while smaller ones gained nothing.
+
+        """
+        return self._max_memory
+
+    @max_memory.setter
+    def max_memory(self, max_memory):
+        self._max_memory = max_memory
+        if hasattr(self, '_kernels'):
+            self._kernels.nmax = self._kernel_nmax()
+
+    @property
+    def prune_tol(self):
+        """If not ``None``, each cluster's KDE is evaluated only at points
+        near enough to it that some kernel exceeds ``prune_tol`` times
+        its peak.  The error in each cluster's contribution is then at
+        most ``prune_tol`` times the largest density it could
+        contribute.  This saves most of the work for posteriors with
+        many well-separated clusters.  If ``None`` (default), the
+        posterior is exact.
+
+        """
+        return self._prune_tol
+
+    @prune_tol.setter
+    def prune_tol(self, prune_tol):
+        if hasattr(self, '_kernels'):
+            self._kernels.prune_tol = prune_tol
+        self._prune_tol = prune_tol
+
+    def _kernel_nmax(self):
+        # Half the budget for the block of kernel values ...
+        return max(1, self.max_memory // (2*np.dtype(np.float64).itemsize))
+
+    def _chunk_size(self, nimages):
+        # ... and half for the per-point arrays: the reflected images
+        # and their whitened copies, squared norms and results.
+        ndim = self.kde_pts.shape[1]
+        per_pt = nimages*(4*ndim + 2)*np.dtype(np.float64).itemsize
+        return max(1, self.max_memory // (2*per_pt))
+
+    @property
+    def max_cluster_pts(self):
+        """The maximum number of KDE points used to optimise the
+        clustering (``None`` for no limit).
+
+        """
+        return self._max_cluster_pts
+
+    @property
+    def clustering_npts(self):
+        """The number of KDE points on which the clustering was optimised.
+        If this is smaller than the number of KDE points, the
+        clustering was chosen on a random subsample.
+
+        """
+        return self._clustering_npts
+
     @property
     def k(self):
         """Returns the optimized number of clusters.
@@ -216,7 +1206,8 @@ class ClusteredSkyKDEPosterior(object):
 
     @property
     def kdes(self):
-        """Returns the scipy KDE object associated with each cluster.
+        """Returns the scipy KDE object associated with each cluster.  These
+        define the kernels, but :meth:`posterior` does not call them.
 
         """
         return self._kdes
@@ -229,12 +1220,39 @@ class ClusteredSkyKDEPosterior(object):
         """
         return self._weights
 
+    @property
+    def min_kernel_scale(self):
+        """The smallest angular standard deviation, in radians, of any
+        cluster's kernel; the finest scale on which the posterior
+        varies.
+
+        """
+        scales = []
+        for kde in self.kdes:
+            # Convert the (ra, sin(dec)) covariance to angles on the sky
+            # at the typical declination of the cluster.
+            cos_dec = np.mean(np.sqrt(1.0 - np.clip(kde.dataset[1,:], -1.0, 1.0)**2))
+            jacobian = np.diag([cos_dec, 1.0/cos_dec])
+            cov = np.dot(jacobian, np.dot(kde.covariance, jacobian))
+            scales.append(np.sqrt(np.min(nl.eigvalsh(cov))))
+        return min(scales)
+
+    @property
+    def ranking_posteriors(self):
+        """Returns the posterior values at ``self.ranking_pts``, in the same
+        (unsorted) order.
+
+        """
+        return self._ranking_posteriors
+
     @property
     def greedy_order(self):
         """Returns the ordering of ``self.ranking_pts`` from highest to lowest
-        posterior values.
+        posterior values.  This is only sorted when first needed.
 
         """
+        if self._greedy_order is None:
+            self._greedy_order = np.argsort(self.ranking_posteriors)[::-1]
         return self._greedy_order
 
     @property
@@ -242,29 +1260,79 @@ class ClusteredSkyKDEPosterior(object):
         """Returns the posterior values at ``self.ranking_pts`` in greedy order.
 
         """
+        if self._greedy_posteriors is None:
+            self._greedy_posteriors = self.ranking_posteriors[self.greedy_order]
         return self._greedy_posteriors
 
-    def _set_up_optimal_k(self):
-        self._set_up_kmeans(1)
-        low_bic = self._bic()
+    def _set_ranking_posteriors(self, posts):
+        self._ranking_posteriors = posts
+        self._greedy_order = None
+        self._greedy_posteriors = None
+
+    @_profiled('clustering')
+    def _set_up_clustering(self, warm_means=None):
+        npts = self.kde_pts.shape[0]
+        if self.max_cluster_pts is None or npts <= self.max_cluster_pts:
+            self._clustering_npts = npts
+            self._set_up_optimal_k(warm_means)
+            return
+
+        # Choose k, and the best trial, on a subsample ...
+        kde_pts, kde_weights = self._kde_pts, self._kde_weights
+        sel = self.random_state.permutation(npts)[:self.max_cluster_pts]
+        self._kde_pts = kde_pts[sel]
+        if kde_weights is not None:
+            self._kde_weights = kde_weights[sel]
+        try:
+            self._set_up_optimal_k(warm_means)
+        finally:
+            self._kde_pts, self._kde_weights = kde_pts, kde_weights
+        self._clustering_npts = sel.shape[0]
+
+        # ... then assign all the points once.
+        cov = np.cov(self.kde_pts, rowvar=0, aweights=self.kde_weights)
+        assign = km_assign(self.means, cov, self.kde_pts)
+        means = km_centroids(self.kde_pts, assign, self.k, weights=self.kde_weights,
+                             random_state=self.random_state)
+        self._set_up_kmeans(self.k, means, assign)
+
+    def _set_up_optimal_k(self, warm_means=None):
+        if warm_means is None:
+            low_k, mid_k, high_k = 1, 2, 4
+        else:
+            # Bracket the previous optimum.
+            mid_k = max(warm_means.shape[0], 2)
+            low_k, high_k = mid_k - 1, mid_k + 1
+
+        low_bic = self._set_up_optimal_kmeans(low_k, self.ntrials, warm_means)
         low_assign = self.assign
         low_means = self.means
-        low_k = 1
 
-        mid_bic = self._set_up_optimal_kmeans(2, self.ntrials)
+        mid_bic = self._set_up_optimal_kmeans(mid_k, self.ntrials, warm_means)
         mid_assign = self.assign
         mid_means = self.means
-        mid_k = 2
 
-        high_bic = self._set_up_optimal_kmeans(4, self.ntrials)
+        high_bic = self._set_up_optimal_kmeans(high_k, self.ntrials, warm_means)
         high_assign = self.assign
         high_means = self.means
 
-        low_k, mid_k, high_k = 1, 2, 4
-            
+        while low_k > 1 and low_bic > mid_bic:
+            logger.debug('extending ks down: %s with bics: %s',
+                         (low_k, mid_k, high_k), (low_bic, mid_bic, high_bic))
+
+            mid_k, high_k = low_k, mid_k
+            mid_bic, high_bic = low_bic, mid_bic
+            mid_means, high_means = low_means, mid_means
+            mid_assign, high_assign = low_assign, mid_assign
+
+            low_k = mid_k/2
+            low_bic = self._set_up_optimal_kmeans(low_k, self.ntrials, warm_means)
+            low_means = self.means
+            low_assign = self.assign
+
         while high_bic > mid_bic:
-            print 'extending ks: ', (low_k, mid_k, high_k)
-            print 'with bics: ', (low_bic, mid_bic, high_bic)
+            logger.debug('extending ks: %s with bics: %s',
+                         (low_k, mid_k, high_k), (low_bic, mid_bic, high_bic))
 
             low_k, mid_k = mid_k, high_k
             low_bic, mid_bic = mid_bic, high_bic
@@ -274,7 +1342,7 @@ class ClusteredSkyKDEPosterior(object):
             high_k = 2*mid_k
             while True:
                 try:
-                    high_bic = self._set_up_optimal_kmeans(high_k, self.ntrials)
+                    high_bic = self._set_up_optimal_kmeans(high_k, self.ntrials, warm_means)
                     high_means = self.means
                     high_assign = self.assign
                 except:
@@ -286,12 +1354,12 @@ class ClusteredSkyKDEPosterior(object):
                 break
 
         while high_k - low_k > 2:
-            print 'shrinking ks: ', (low_k, mid_k, high_k)
-            print 'with bics: ', (low_bic, mid_bic, high_bic)
+            logger.debug('shrinking ks: %s with bics: %s',
+                         (low_k, mid_k, high_k), (low_bic, mid_bic, high_bic))
 
             if high_k - mid_k > mid_k - low_k:
                 k = mid_k + (high_k - mid_k)/2
-                bic = self._set_up_optimal_kmeans(k, self.ntrials)
+                bic = self._set_up_optimal_kmeans(k, self.ntrials, warm_means)
                 means = self.means
                 assign = self.assign
 
@@ -307,7 +1375,7 @@ class ClusteredSkyKDEPosterior(object):
                     high_assign = assign
             else:
                 k = low_k + (mid_k - low_k)/2
-                bic = self._set_up_optimal_kmeans(k, self.ntrials)
+                bic = self._set_up_optimal_kmeans(k, self.ntrials, warm_means)
                 means = self.means
                 assign = self.assign
 
@@ -322,17 +1390,25 @@ class ClusteredSkyKDEPosterior(object):
                     low_means = means
                     low_assign = assign
             
-        print 'Found best k, BIC: ', mid_k, mid_bic
+        logger.info('found best k = %d, BIC = %g', mid_k, mid_bic)
+        self._report_progress('clustering', k=mid_k, bic=mid_bic, done=True)
         self._set_up_kmeans(mid_k, mid_means, mid_assign)
 
-    def _set_up_optimal_kmeans(self, k, ntrials):
+    def _set_up_optimal_kmeans(self, k, ntrials, warm_means=None):
         best_bic = np.NINF
-        
-        for i in range(ntrials):
-            self._set_up_kmeans(k)
+
+        if k == 1 or (warm_means is not None and k <= warm_means.shape[0]):
+            # The k-means result is deterministic, so there is no
+            # point in repeating it.
+            ntrials = 1
+
+        for trial in range(ntrials):
+            self._set_up_kmeans(k, init_means=self._initial_means(k, warm_means))
             bic = self._bic()
 
-            print 'k = ', k, 'ntrials = ', ntrials, 'bic = ', bic
+            logger.debug('k = %d, trial %d of %d, bic = %g', k, trial+1, ntrials, bic)
+            self._report_progress('clustering', k=k, trial=trial, ntrials=ntrials,
+                                  bic=bic, done=False)
             
             if bic >= best_bic:
                 best_means = self.means
@@ -342,11 +1418,34 @@ class ClusteredSkyKDEPosterior(object):
         self._set_up_kmeans(k, means=best_means, assign=best_assign)
         return best_bic
 
-    def _set_up_kmeans(self, k, means=None, assign=None):
+    def _initial_means(self, k, warm_means):
+        """Returns ``k`` initial centroids derived from ``warm_means``, or
+        ``None`` for a cold start.
+
+        """
+        if warm_means is None or k == 1:
+            return None
+
+        nwarm = warm_means.shape[0]
+        if k <= nwarm:
+            # Keep the k most populous of the previous clusters.
+            cov = np.cov(self.kde_pts, rowvar=0, aweights=self.kde_weights)
+            counts = np.bincount(km_assign(warm_means, cov, self.kde_pts),
+                                 weights=self.kde_weights, minlength=nwarm)
+            return warm_means[np.sort(np.argsort(counts)[::-1][:k]), :]
+        else:
+            # Seed the extra clusters from random points.
+            extra = self.random_state.permutation(self.kde_pts)[:k-nwarm, :]
+            return np.concatenate((warm_means, extra), axis=0)
+
+    def _set_up_kmeans(self, k, means=None, assign=None, init_means=None):
         self._k = k
 
         if means is None or assign is None:
-            self._means, self._assign = k_means(self.kde_pts, k)
+            self._means, self._assign, niter = _k_means(self.kde_pts, k, means=init_means,
+                                                        weights=self.kde_weights,
+                                                        random_state=self.random_state)
+            self.profile.count('kmeans_iterations', niter)
         else:
             self._means = means
             self._assign = assign
@@ -360,54 +1459,216 @@ class ClusteredSkyKDEPosterior(object):
             # bother adding a KDE for that cluster; its covariance would be
             # singular.
             if np.sum(sel) > ndim:
-                self._kdes.append(gaussian_kde(self.kde_pts[sel,:].T))
-                self._weights.append(float(np.sum(sel)))
+                if self.kde_weights is None:
+                    self._kdes.append(gaussian_kde(self.kde_pts[sel,:].T))
+                    self._weights.append(float(np.sum(sel)))
+                else:
+                    self._kdes.append(gaussian_kde(self.kde_pts[sel,:].T,
+                                                   weights=self.kde_weights[sel]))
+                    self._weights.append(np.sum(self.kde_weights[sel]))
         self._weights = np.array(self.weights)
 
         # Normalize the weights
         self._weights = self._weights / np.sum(self._weights)
 
+        self._kernels = _ClusterKernels(self.kdes, self.weights, nmax=self._kernel_nmax(),
+                                        prune_tol=self.prune_tol)
+
+    @_profiled('greedy')
     def _set_up_greedy_order(self):
         pts = self.ranking_pts.copy()
         pts[:,1] = np.arcsin(pts[:,1])
 
-        posts = self.posterior(pts)
-        self._greedy_order = np.argsort(posts)[::-1]
-        self._greedy_posteriors = posts[self.greedy_order]
+        self._set_ranking_posteriors(self.posterior(pts))
 
-    def posterior(self, pts):
+    @_profiled('update')
+    def update(self, new_pts, z_threshold=3.0, sample_weights=None):
+        """Incorporates a new batch of RA-DEC samples into the posterior
+        without rebuilding it from scratch.
+
+        The new samples are split between the KDE and ranking sets as
+        in the constructor.  The new KDE points are assigned to the
+        nearest existing cluster, and the cluster weights and
+        bandwidths are updated from the enlarged clusters without
+        re-running k-means.  The new ranking points are merged into
+        the existing greedy order; the posterior values of the
+        existing ranking points are not re-evaluated.
+
+        If the new samples are poorly described by the current
+        clustering---that is, their mean log-posterior falls
+        significantly below that of the existing ranking points---then
+        the clustering is re-optimised (warm-started from the current
+        centroids) and the greedy order is rebuilt.
+
+        :param new_pts: The new sky points, in RA-DEC coordinates.
+
+        :param z_threshold: The number of standard errors by which the
+          mean log-posterior of the new samples must fall below that
+          of the ranking points to trigger a full re-clustering.  The
+          standard error is estimated from the spread of the
+          log-posteriors in both sets, so the test does not become
+          more sensitive as the batches grow.
+
+        :param sample_weights: The weights of the new samples.
+          Required if, and only if, the posterior was constructed from
+          weighted samples.
+
+        :return: ``True`` if a full re-clustering was performed.
+
+        """
+        if (sample_weights is None) != (self.kde_weights is None):
+            raise ValueError('sample_weights must be given if and only if '
+                             'the posterior has weighted samples')
+
+        new_pts = np.atleast_2d(new_pts)
+        if new_pts.shape[0] == 0:
+            return False
+
+        perm = self.random_state.permutation(new_pts.shape[0])
+        ppts = new_pts[perm]
+        posts = self.posterior(ppts)
+
+        ppts[:,1] = np.sin(ppts[:,1])
+        new_kde_pts = ppts[::2]
+        new_ranking_pts = ppts[1::2]
+
+        # The ranking points are independent of the KDE, so their mean
+        # log-posterior is the expected per-sample log-likelihood of
+        # new samples if the clustering is still good.
+        # Compare the two means by their difference in units of its
+        # standard error; a batch drawn from the same distribution
+        # gives z of order one whatever its size.
+        if sample_weights is not None:
+            pweights = np.asarray(sample_weights, dtype=float)[perm]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_mean, new_var = _log_post_moments(posts, None if sample_weights is None
+                                                  else pweights)
+            old_mean, old_var = _log_post_moments(self.ranking_posteriors,
+                                                  self.ranking_weights)
+            z = (new_mean - old_mean)/np.sqrt(new_var + old_var)
+
+        nranking = self.ranking_pts.shape[0]
+        nkde = self.kde_pts.shape[0]
+        self._pts = np.concatenate((self.pts, ppts), axis=0)
+        self._kde_pts = np.concatenate((self.kde_pts, new_kde_pts), axis=0)
+        self._ranking_pts = np.concatenate((self.ranking_pts, new_ranking_pts), axis=0)
+        if sample_weights is not None:
+            self._kde_weights = np.concatenate((self.kde_weights, pweights[::2]))
+            self._ranking_weights = np.concatenate((self.ranking_weights, pweights[1::2]))
+
+        # New samples where the posterior vanishes are never described
+        # by it.  Otherwise z can only be undefined (nan) if the
+        # log-posteriors have no spread at all, which is no evidence
+        # against the clustering.
+        if np.any(posts <= 0.0) or z < -z_threshold:
+            self._set_up_clustering(self.means)
+            self._set_up_greedy_order()
+            return True
+
+        cov = np.cov(self.kde_pts, rowvar=0, aweights=self.kde_weights)
+        assign = np.concatenate((self.assign, km_assign(self.means, cov, new_kde_pts)))
+        means = km_centroids(self.kde_pts, assign, self.k, weights=self.kde_weights,
+                             random_state=self.random_state)
+        self._set_up_kmeans(self.k, means, assign)
+        if self.clustering_npts == nkde:
+            # The clustering was optimised on every KDE point, and still
+            # covers every one.
+            self._clustering_npts = self.kde_pts.shape[0]
+
+        if self._greedy_order is None:
+            # Nothing sorted yet, so nothing to merge into.
+            self._set_ranking_posteriors(np.concatenate((self.ranking_posteriors, posts[1::2])))
+            return False
+
+        new_posts = posts[1::2]
+        new_order = np.argsort(new_posts)[::-1]
+        idxs = np.searchsorted(-self.greedy_posteriors, -new_posts[new_order], side='right')
+        greedy_order = np.insert(self.greedy_order, idxs, nranking + new_order)
+        greedy_posteriors = np.insert(self.greedy_posteriors, idxs, new_posts[new_order])
+
+        self._set_ranking_posteriors(np.concatenate((self.ranking_posteriors, new_posts)))
+        self._greedy_order = greedy_order
+        self._greedy_posteriors = greedy_posteriors
+
+        return False
+
+    def posterior(self, pts, dtype=None, rtol=None):
         """Returns the clustered KDE estimate of the sky density per steradian
         at the given points in RA-DEC.
 
+        :param dtype: If not ``None``, a reduced floating-point precision
+          (e.g. ``np.float32``) at which to evaluate the kernels, which
+          halves the memory of the kernel blocks (the time is mostly
+          spent in the exponentials, so it is only a little faster).
+          The sums over clusters are
+          accumulated, and returned, in double precision.  Beyond the
+          rounding of each kernel, kernels below the smallest value
+          the reduced precision can hold (about ``exp(-100)`` for
+          ``np.float32``) are flushed to exactly zero, so the density
+          far from every sample is zero rather than small.  Use this
+          for display maps, not for ranking or areas.
+
+        :param rtol: If not ``None``, approximate the KDE by binning
+          each cluster onto a grid, with errors of order ``rtol``
+          times the peak density.  This is much faster for many
+          points (e.g. full-sky maps); the grids are built on the
+          first call with a given ``rtol``.  ``dtype`` is then
+          ignored.
+
         """
         pts = pts.copy()
         pts = np.atleast_2d(pts)
         pts[:,1] = np.sin(pts[:,1])
-        
-        post = np.zeros(pts.shape[0])
 
-        ras = pts[:,0]
-        sin_decs = pts[:,1]
+        return self._sin_dec_posterior(pts, dtype=dtype, rtol=rtol)
 
-        for dra in [0.0, 2.0*np.pi, -2.0*np.pi]:
-            pts = np.column_stack((ras+dra, sin_decs))
-            post += self._posterior(pts)
+    def _sin_dec_posterior(self, pts, dtype=None, rtol=None):
+        """Like :meth:`posterior`, but for points in ``(ra, sin(dec))``.
 
-            pts = np.column_stack((ras+dra, 2.0 - sin_decs))
-            post += self._posterior(pts)
+        """
+        self.profile.count('posterior_evaluations', pts.shape[0])
 
-            pts = np.column_stack((ras+dra, -2.0 - sin_decs))
-            post += self._posterior(pts)
+        post = np.zeros(pts.shape[0])
+        with self._shared_workers():
+            for low, high in self._split_range(pts.shape[0], nmax=self._chunk_size(9)):
+                post[low:high] = self._reflected_posterior(pts[low:high], dtype=dtype,
+                                                           rtol=rtol)
 
         return post
 
-    def _posterior(self, pts):
-        post = np.zeros(pts.shape[0])
+    def _reflected_posterior(self, pts, dtype=None, rtol=None):
+        ras = pts[:,0]
+        sin_decs = pts[:,1]
+
+        images = []
+        for dra in [0.0, 2.0*np.pi, -2.0*np.pi]:
+            images.append(np.column_stack((ras+dra, sin_decs)))
+            images.append(np.column_stack((ras+dra, 2.0 - sin_decs)))
+            images.append(np.column_stack((ras+dra, -2.0 - sin_decs)))
 
-        for kde, weight in zip(self.kdes, self.weights):
-            post += weight*kde(pts.T)
+        # Evaluate all nine reflected images of the points together.
+        post = self._posterior(np.concatenate(images, axis=0), dtype=dtype, rtol=rtol)
 
-        return post
+        return np.sum(post.reshape((len(images), -1)), axis=0)
+
+    def _posterior(self, pts, dtype=None, rtol=None):
+        if rtol is None:
+            kernels = self._kernels
+            self.profile.peak('peak_array_size',
+                              kernels.block_size(pts.shape[0])*kernels.max_n)
+            work = pts.shape[0]*kernels.max_n
+        else:
+            kernels = self._kernels.binned(rtol)
+            work = pts.shape[0]*len(self.weights)
+
+        if (self.n_jobs > 1 and work >= self._min_parallel_work
+                and not mp.current_process().daemon):
+            if self._workers is not None:
+                return self._workers.evaluate(kernels, pts, dtype=dtype)
+            with _WorkerPool(self.n_jobs) as workers:
+                return workers.evaluate(kernels, pts, dtype=dtype)
+        else:
+            return kernels(pts, dtype=dtype)
 
     def __call__(self, pts):
         """Synonym for ``self.posterior()``.
@@ -415,6 +1676,7 @@ class ClusteredSkyKDEPosterior(object):
         """
         return self.posterior(pts)
 
+    @_profiled('bic')
     def _bic(self):
         """Returns the BIC for the point set being drawn from the clustered
         KDE.
@@ -437,7 +1699,22 @@ class ClusteredSkyKDEPosterior(object):
         pts = self.kde_pts.copy()
         pts[:,1] = np.arcsin(pts[:,1])
 
-        return np.sum(np.log(self.posterior(pts))) - nparams/2.0*np.log(self.kde_pts.shape[0])
+        log_like, npts = self._kde_log_likelihood(np.log(self.posterior(pts)))
+
+        return log_like - nparams/2.0*np.log(npts)
+
+    def _kde_log_likelihood(self, log_posts):
+        """Returns the log-likelihood of ``self.kde_pts`` given their log
+        posterior values, and the (effective, if weighted) number of
+        points.
+
+        """
+        if self.kde_weights is None:
+            return np.sum(log_posts), log_posts.shape[0]
+        else:
+            w = self.kde_weights
+            neff = np.sum(w)**2/np.sum(w*w)
+            return neff*np.average(log_posts, weights=w), neff
 
     def _split_range(self, n, nmax=100000):
         if n < nmax:
@@ -449,20 +1726,46 @@ class ClusteredSkyKDEPosterior(object):
 
             return zip(lows, highs)
 
+    @_profiled('grid')
     def _adaptive_grid(self):
         pts = self.pts.copy()
         pts[:,1] = np.arcsin(pts[:,1])
 
         return _Hp_adaptive_grid_pixel(pts)
 
-    def _as_healpix_slow(self, nside, nest=True):
+    def auto_nside(self, acc=None, nside_max=1<<13):
+        """Returns the coarsest healpix resolution (a power of two) that
+        resolves the posterior well enough for areas accurate to
+        ``acc``: one whose pixels are no larger than ``min(1,
+        50*acc)`` times :attr:`min_kernel_scale`.
+
+        :param acc: The accuracy (default ``self.acc``).
+
+        :param nside_max: The largest ``nside`` to return.
+
+        """
+        if acc is None:
+            acc = self.acc
+
+        resol = min(1.0, 50.0*acc)*self.min_kernel_scale
+
+        nside = 1
+        while hp.nside2resol(nside) > resol and nside < nside_max:
+            nside *= 2
+        return nside
+
+    @_profiled('map')
+    def _as_healpix_slow(self, nside, nest=True, dtype=None, rtol=None):
         npix = hp.nside2npix(nside)
-        thetas, phis = hp.pix2ang(nside, np.arange(npix), nest=nest)
-        pixels = np.column_stack((phis, np.pi/2.0 - thetas))
-        pixel_posts = self.posterior(pixels)
+        pixel_posts = np.empty(npix)
+        with self._shared_workers():
+            for low, high in self._split_range(npix):
+                pixels = pixel_centres.centres(nside, low, high, nest=nest)
+                pixel_posts[low:high] = self._sin_dec_posterior(pixels, dtype=dtype, rtol=rtol)
         return pixel_posts / np.sum(pixel_posts)
     
-    def _as_healpix_fast(self, nside, nest=True):
+    @_profiled('map')
+    def _as_healpix_fast(self, nside, nest=True, dtype=None):
         """Returns a healpix map of the posterior density, by default in
         nested order.
 
@@ -471,7 +1774,7 @@ class ClusteredSkyKDEPosterior(object):
 
         pcentres, nsides = grid.pixel_centers_nsides()
         pcentres = np.array(pcentres)
-        pposts = self.posterior(pcentres)
+        pposts = self.posterior(pcentres, dtype=dtype)
         
         map = np.zeros(hp.nside2npix(nside))
 
@@ -504,7 +1807,7 @@ class ClusteredSkyKDEPosterior(object):
 
         return map / np.sum(map)
 
-    def as_healpix(self, nside, nest=True, fast=True):
+    def as_healpix(self, nside, nest=True, fast=True, dtype=None, rtol=None):
         """Return a healpix map of the posterior at the given resolution.
 
         :param nside: The resolution parameter.
@@ -514,12 +1817,22 @@ class ClusteredSkyKDEPosterior(object):
         :param fast: If ``True`` produce a map more quickly, at the
           cost of some pixellation.
 
+        :param dtype: If not ``None``, evaluate the posterior at this
+          reduced precision (see :meth:`posterior`).  The map itself
+          is double precision.
+
+        :param rtol: If not ``None`` and ``fast`` is ``False``,
+          approximate the posterior at each pixel to this accuracy
+          relative to its peak (see :meth:`posterior`), which makes
+          smooth maps at high ``nside`` affordable.
+
         """
         if fast:
-            return self._as_healpix_fast(nside, nest=nest)
+            return self._as_healpix_fast(nside, nest=nest, dtype=dtype)
         else:
-            return self._as_healpix_slow(nside, nest=nest)
+            return self._as_healpix_slow(nside, nest=nest, dtype=dtype, rtol=rtol)
 
+    @_profiled('area')
     def _fast_area_within(self, levels):
         grid = self._adaptive_grid()
 
@@ -528,31 +1841,42 @@ class ClusteredSkyKDEPosterior(object):
         pareas = np.array([hp.nside2pixarea(ns) for ns in nsides])
         plevels = self.posterior(pcenters)
 
-        areas = []
-        for l in levels:
-            areas.append(np.sum(pareas[plevels >= l]))
+        # Sort once, so that any number of levels costs only a search.
+        order = np.argsort(plevels)[::-1]
+        cum_areas = np.concatenate(([0.0], np.cumsum(pareas[order])))
+        nabove = np.searchsorted(-plevels[order], -np.asarray(levels), side='right')
 
-        return np.array(areas)
+        return cum_areas[nabove]
     
     def _area_within_nside(self, levels, nside):
-        npix = hp.nside2npix(nside)
         pixarea = hp.nside2pixarea(nside)
         
         areas = 0.0
-        for low, high in self._split_range(npix):
-            thetas, phis = hp.pix2ang(nside, np.arange(low, high, dtype=np.int))
-            pixels = np.column_stack((phis, np.pi/2.0 - thetas))
+        with self._shared_workers():
+            for low, high in self._split_range(hp.nside2npix(nside)):
+                pixels = pixel_centres.centres(nside, low, high)
+                pixel_posts = np.sort(self._sin_dec_posterior(pixels))
 
-            pixel_posts = self.posterior(pixels)
-
-            sub_areas = np.array([pixarea*np.sum(pixel_posts > l) for l in levels])
-            areas = areas + sub_areas
+                nabove = pixel_posts.shape[0] - np.searchsorted(pixel_posts, levels,
+                                                                side='right')
+                sub_areas = pixarea*nabove
+                areas = areas + sub_areas
 
         return areas
 
-    def _area_within(self, levels, nside_max=512):
+    @_profiled('area')
+    def _area_within(self, levels, nside_max=2048):
         levels = np.atleast_1d(levels)
 
+        # One doubling beyond the resolving nside, for the
+        # extrapolation, but no further than the caller allows: each
+        # doubling quadruples the time taken.
+        nside_max = min(nside_max, 2*self.auto_nside())
+
+        with self._shared_workers():
+            return self._area_within_nsides(levels, nside_max)
+
+    def _area_within_nsides(self, levels, nside_max):
         nside = 1
         old_areas = np.zeros(levels.shape[0])
         while True:
@@ -563,45 +1887,149 @@ class ClusteredSkyKDEPosterior(object):
 
             error = np.abs((areas - extrap_areas)/extrap_areas)
 
-            print 'Calculated sky area at nside = ', nside
-            print 'Areas are ', extrap_areas
-            print
+            logger.debug('calculated sky areas %s at nside = %d', extrap_areas, nside)
+            self._report_progress('area', nside=nside, nside_max=nside_max,
+                                  areas=extrap_areas)
 
             if np.all(areas > 0) and np.all(error < self.acc):
                 return extrap_areas
             elif nside >= nside_max:
-                print 'Ending sky area calculation at nside = ', nside
+                logger.warning('sky areas not converged to accuracy %g at nside = %d',
+                               self.acc, nside)
                 return extrap_areas
             else:
                 old_areas = areas
 
-    def sky_area(self, cls, fast=True):
+    def sky_area(self, cls, fast=True, nside_max=2048):
         """Returns the sky area occupied by the given list of credible levels.
         If ``fast``, then use a fast algorithm that is usually
         accurate but not guaranteed to converge to the correct answer.
+        Otherwise, the areas are integrated on healpix grids of
+        increasing resolution, up to ``nside_max``.
 
         """
         cls = np.atleast_1d(cls)
-        idxs=[int(round(cl*self.ranking_pts.shape[0])) for cl in cls]
-        missed=False
-        if idxs[-1]==len(self.greedy_posteriors):
-          # this can happen if the injected position is totally missed
-          idxs[-1]-=1
-          missed=True
-
-        post_levels = [self.greedy_posteriors[i] for i in idxs]
+        post_levels, missed = _direct_levels(self.ranking_posteriors, self.ranking_weights,
+                                             cls)
 
         if fast:
             out=self._fast_area_within(post_levels)
         else:
-            out=self._area_within(post_levels)
+            out=self._area_within(post_levels, nside_max=nside_max)
 
-        if missed:
-          # if missed set the searched are to be the whole sky
-          out[-1]=4*np.pi
+        # A level beyond every ranking point (e.g. a totally missed
+        # injection) means searching the whole sky.
+        out[missed]=4*np.pi
         return out
 
 
+    def _kde_draws(self, n):
+        """Returns ``n`` points, in ``(ra, sin(dec))``, drawn from the
+        clustered KDE: a KDE point chosen by weight, displaced by its
+        cluster's kernel, and folded back onto the sky as the
+        reflected images are in :meth:`posterior`.
+
+        """
+        random_state = self.random_state
+
+        clusters = random_state.choice(len(self.kdes), size=n, p=self.weights)
+        draws = np.empty((n, 2))
+        for i, kde in enumerate(self.kdes):
+            sel = np.flatnonzero(clusters == i)
+            if sel.shape[0] == 0:
+                continue
+            kweights = kde.weights if hasattr(kde, 'weights') else None
+            centres = random_state.choice(kde.n, size=sel.shape[0], p=kweights)
+            draws[sel] = kde.dataset[:, centres].T + random_state.multivariate_normal(
+                np.zeros(kde.d), kde.covariance, size=sel.shape[0])
+
+        draws[:,0] = np.mod(draws[:,0], 2.0*np.pi)
+        sin_decs = draws[:,1]
+        sin_decs = np.where(sin_decs > 1.0, 2.0 - sin_decs, sin_decs)
+        sin_decs = np.where(sin_decs < -1.0, -2.0 - sin_decs, sin_decs)
+        draws[:,1] = np.clip(sin_decs, -1.0, 1.0)
+
+        return draws
+
+    @_profiled('area')
+    def sky_area_direct(self, cls, nboot=100, max_rel_error=0.25, fast=True, ndraws=None):
+        """Returns Monte-Carlo estimates of the sky area occupied by the
+        given credible levels, without integrating over the sky, and
+        their bootstrap errors.
+
+        The levels bounding the credible regions are found from the
+        ranking points, as in :meth:`sky_area`.  The area where the
+        posterior density ``p`` exceeds a level is the expectation,
+        over points drawn from ``p`` itself, of ``1/p`` where ``p``
+        exceeds the level; the points are drawn from the clustered
+        KDE, so that the estimate is unbiased for the area of the KDE
+        (the ranking points, drawn from the true posterior, would bias
+        it).  This is much cheaper than :meth:`sky_area`, but noisier
+        for levels close to one, where the estimate is dominated by a
+        few draws in the tails.  Areas are never larger than the sky;
+        those whose bootstrap error exceeds ``max_rel_error`` of the
+        estimate are instead computed as in :meth:`sky_area` at the
+        same level.
+
+        :param cls: The credible levels.
+
+        :param nboot: The number of bootstrap resamplings of the
+          ranking points and draws from which to estimate the errors.
+
+        :param max_rel_error: The largest bootstrap error, relative to
+          the area, accepted from the direct estimate.
+
+        :param fast: Passed to :meth:`sky_area` for any areas that
+          fall back to it.
+
+        :param ndraws: The number of points to draw from the KDE
+          (default the number of ranking points).
+
+        :return: ``(areas, errors)``, where ``errors`` are the
+          bootstrap standard deviations of ``areas`` (``nan`` if
+          ``nboot`` is zero, or for the areas computed by
+          :meth:`sky_area`).
+
+        """
+        cls = np.atleast_1d(cls)
+        posts = self.ranking_posteriors
+        weights = self.ranking_weights
+
+        if ndraws is None:
+            ndraws = posts.shape[0]
+        draw_posts = self._sin_dec_posterior(self._kde_draws(ndraws))
+
+        levels, missed = _direct_levels(posts, weights, cls)
+        areas = _direct_areas(levels, missed, draw_posts)
+
+        if nboot == 0:
+            return areas, np.zeros(cls.shape[0]) + np.nan
+
+        boot_areas = []
+        for i in range(nboot):
+            sel = self.random_state.randint(posts.shape[0], size=posts.shape[0])
+            draw_sel = self.random_state.randint(ndraws, size=ndraws)
+            boot_levels, boot_missed = _direct_levels(
+                posts[sel], None if weights is None else weights[sel], cls)
+            boot_areas.append(_direct_areas(boot_levels, boot_missed, draw_posts[draw_sel]))
+        errors = np.std(boot_areas, axis=0)
+
+        unreliable = errors > max_rel_error*areas
+        if np.any(unreliable):
+            logger.info('direct sky areas at credible levels %s are too noisy; '
+                        'integrating them over the sky instead', cls[unreliable])
+            if fast:
+                fallback = self._fast_area_within(levels[unreliable])
+            else:
+                fallback = self._area_within(levels[unreliable])
+            fallback = np.minimum(fallback, 4.0*np.pi)
+            fallback[missed[unreliable]] = 4.0*np.pi
+
+            areas[unreliable] = fallback
+            errors[unreliable] = np.nan
+
+        return areas, errors
+
     def searched_area(self, pts, fast=True):
         """Returns the sky area that must be searched using a greedy algorithm
         before encountering the given points in the sky.  If ``fast``,
@@ -628,11 +2056,14 @@ class ClusteredSkyKDEPosterior(object):
         greedy_levels = self.greedy_posteriors[::-1]
         n = greedy_levels.shape[0]
 
-        indexes = []
-        for pl in post_levels:
-            indexes.append(bs.bisect(greedy_levels, pl))
+        indexes = np.searchsorted(greedy_levels, post_levels, side='right')
 
-        return 1.0 - np.array(indexes)/float(n)
+        if self.ranking_weights is None:
+            return 1.0 - np.array(indexes)/float(n)
+        else:
+            # Total weight of ranking points at or below each level.
+            cum_weights = np.concatenate(([0.0], np.cumsum(self.ranking_weights[self.greedy_order][::-1])))
+            return 1.0 - cum_weights[indexes]/cum_weights[-1]
 
 class Clustered3DKDEPosterior(ClusteredSkyKDEPosterior):
     """Like :class:`ClusteredSkyKDEPosterior`, but clusters in 3D
@@ -642,7 +2073,10 @@ class Clustered3DKDEPosterior(ClusteredSkyKDEPosterior):
 
     """
 
-    def __init__(self, pts, ntrials=5, means=None, assign=None):
+    def __init__(self, pts, ntrials=5, means=None, assign=None,
+                 warm_start=None, sample_weights=None, max_cluster_pts=None,
+                 random_state=None, progress=None, n_jobs=1, max_memory=1<<24,
+                 prune_tol=None):
         """Initialise the posterior object.
 
         :param pts: A ``(npts, 3)`` shaped array.  The first column is
@@ -654,43 +2088,90 @@ class Clustered3DKDEPosterior(ClusteredSkyKDEPosterior):
         :param means: If given, use these means as the clustering centroids.
 
         :param assign: If given, use these assignments for the clustering.
+
+        :param warm_start: If given, a previous posterior (or its
+          ``means``, in Cartesian coordinates) from which to
+          warm-start the clustering.
+
+        :param sample_weights: If given, the weight of each sample.
+
+        :param max_cluster_pts: If given, optimise the clustering on a
+          random subsample of at most this many KDE points.
+
+        :param random_state: If given, the source of randomness (a
+          seed or :class:`numpy.random.RandomState`).
+
+        :param progress: If given, a progress callback; see
+          :attr:`ClusteredSkyKDEPosterior.progress`.
+
+        :param n_jobs: The number of processes among which to share
+          large posterior evaluations; see
+          :attr:`ClusteredSkyKDEPosterior.n_jobs`.
+
+        :param max_memory: The approximate memory budget, in bytes,
+          for evaluating the posterior; see
+          :attr:`ClusteredSkyKDEPosterior.max_memory`.
+
+        :param prune_tol: If not ``None``, skip clusters at points far
+          from them, to this tolerance; see
+          :attr:`ClusteredSkyKDEPosterior.prune_tol`.
         """
         
+        self._profile = StageProfile()
+        self._progress = progress
+        self._n_jobs = n_jobs
+        self._workers = None
+        self._max_memory = max_memory
+        self._prune_tol = prune_tol
+
         xyzpts = self._pts_to_xyzpts(pts)
         
         self._pts = xyzpts
 
-        ppts = np.random.permutation(xyzpts)
+        self._random_state = check_random_state(random_state)
 
-        self._kde_pts = ppts[::2]
-        self._ranking_pts = ppts[1::2]
+        self._kde_pts, self._ranking_pts, self._kde_weights, self._ranking_weights = \
+            _split_pts(xyzpts, sample_weights, self.random_state)
         self._ntrials = ntrials
+        self._max_cluster_pts = max_cluster_pts
 
         if means is None or assign is None:
-            self._set_up_optimal_k()
+            self._set_up_clustering(_warm_start_means(warm_start))
         else:
-            self._set_up_kmeans(means.shape[0], means, assign)
+            self._clustering_npts = self.kde_pts.shape[0]
+            with self.profile.stage('clustering'):
+                self._set_up_kmeans(means.shape[0], means, assign)
 
         self._set_up_greedy_order()
 
-    def _pts_to_xyzpts(self, pts):
+    def _pts_to_xyzpts(self, pts, out=None):
+        """Converts the ``(npts, 3)`` array of RA, DEC, distance ``pts`` to
+        Cartesian coordinates, writing them to the ``(npts, 3)`` array
+        ``out`` if given.
+
+        """
         ras = pts[:,0]
         decs = pts[:,1]
         ds = pts[:,2]
-        
-        xyzpts = np.column_stack((ds*np.cos(ras)*np.cos(decs),
-                                  ds*np.sin(ras)*np.cos(decs),
-                                  ds*np.sin(decs)))
 
-        return xyzpts
+        if out is None:
+            out = np.empty((pts.shape[0], 3))
 
+        d_cos_decs = np.cos(decs)
+        d_cos_decs *= ds
 
-    def _set_up_greedy_order(self):
-        pts = self.ranking_pts.copy()
+        np.cos(ras, out=out[:,0])
+        out[:,0] *= d_cos_decs
+        np.sin(ras, out=out[:,1])
+        out[:,1] *= d_cos_decs
+        np.sin(decs, out=out[:,2])
+        out[:,2] *= ds
 
-        posts = self.posterior(pts)
-        self._greedy_order = np.argsort(posts)[::-1]
-        self._greedy_posteriors = posts[self.greedy_order]
+        return out
+
+    @_profiled('greedy')
+    def _set_up_greedy_order(self):
+        self._set_ranking_posteriors(self.posterior_xyz(self.ranking_pts))
 
     def posterior(self, pts):
         """Given an array of positions in RA, DEC, dist, compute the 3D
@@ -700,26 +2181,45 @@ class Clustered3DKDEPosterior(ClusteredSkyKDEPosterior):
         
         pts = np.atleast_2d(pts)
 
-        xyzpts = self._pts_to_xyzpts(pts)
+        self.profile.count('posterior_evaluations', pts.shape[0])
+
+        post = np.zeros(pts.shape[0])
+        xyzpts = np.empty((min(pts.shape[0], self._chunk_size(1)), 3))
+        with self._shared_workers():
+            for low, high in self._split_range(pts.shape[0], nmax=self._chunk_size(1)):
+                post[low:high] = self._posterior(self._pts_to_xyzpts(pts[low:high],
+                                                                     out=xyzpts[:high-low]))
+
+        return post
+
+    def posterior_xyz(self, xyzpts):
+        """Like :meth:`posterior`, but for an array of Cartesian positions
+        (in Mpc), avoiding any conversion.
+
+        """
+        xyzpts = np.atleast_2d(xyzpts)
 
-        return self._posterior(xyzpts)
+        self.profile.count('posterior_evaluations', xyzpts.shape[0])
 
+        post = np.zeros(xyzpts.shape[0])
+        with self._shared_workers():
+            for low, high in self._split_range(xyzpts.shape[0], nmax=self._chunk_size(1)):
+                post[low:high] = self._posterior(xyzpts[low:high])
+
+        return post
+
+    @_profiled('bic')
     def _bic(self):
         ndim = self.kde_pts.shape[1]
         npts = self.kde_pts.shape[0]
 
         nparams = self.k*ndim + self.k*((ndim+1)*(ndim)/2) + self.k - 1
 
-        xyzpts = self.kde_pts
-        ds = np.sqrt(np.sum(np.square(xyzpts), axis=1))
-        ras = np.arctan2(xyzpts[:,1], xyzpts[:,0])
-        sin_dec = xyzpts[:,2] / ds
-        dec = np.arcsin(sin_dec)
+        log_like, npts = self._kde_log_likelihood(np.log(self.posterior_xyz(self.kde_pts)))
 
-        pts = np.column_stack((ras, dec, ds))
-        
-        return np.sum(np.log(self.posterior(pts))) - nparams/2.0*np.log(self.kde_pts.shape[0])
+        return log_like - nparams/2.0*np.log(npts)
 
+    @_profiled('map')
     def as_healpix(self, nside, nest=True):
         r"""Returns a healpix map with the mean and standard deviations
         of :math:`d` for any pixel containing at least one posterior
@@ -751,7 +2251,16 @@ class Clustered3DKDEPosterior(ClusteredSkyKDEPosterior):
         # Done!
         return prob, distmu, distsigma, distnorm
 
-    def sky_area(self, cls):
+    def update(self, new_pts, z_threshold=3.0, sample_weights=None):
+        raise NotImplementedError
+
+    def sky_area(self, cls, fast=True, nside_max=2048):
+        raise NotImplementedError
+
+    def sky_area_direct(self, cls, nboot=100, max_rel_error=0.25, fast=True, ndraws=None):
+        raise NotImplementedError
+
+    def auto_nside(self, acc=None, nside_max=1<<13):
         raise NotImplementedError
 
     def searched_area(self, pts):
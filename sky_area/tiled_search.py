@@ -0,0 +1,218 @@
+"""Utilities for simulating searches on the sky with a telescope that
+images a fixed tiling of fields of view.
+
+"""
+
+import healpy as hp
+import numpy as np
+import scipy.sparse as ss
+
+def disc_footprints(nside, ras, decs, radius, nest=True):
+    """Returns the footprints of circular fields of view.
+
+    :param nside: The resolution of the maps to be searched.
+
+    :param ras: The RAs of the field centres.
+
+    :param decs: The DECs of the field centres.
+
+    :param radius: The radius of each field, in radians.
+
+    :param nest: Whether the footprints should be in nested (default)
+      or ring pixel ordering.
+
+    :return: A list of arrays of the pixels that overlap each field.
+
+    """
+    vecs = hp.ang2vec(np.pi/2.0 - np.atleast_1d(decs), np.atleast_1d(ras))
+
+    return [hp.query_disc(nside, v, radius, inclusive=True, nest=nest) for v in vecs]
+
+class TileIndex(object):
+    """A sparse index from the pixels of a healpix map at a given
+    resolution to the tiles of a tiling that cover them.  Build it
+    once per tiling and resolution, and use it to search any number of
+    maps.
+
+    """
+
+    def __init__(self, footprints, nside, nest=True):
+        """Index the given tile footprints.
+
+        :param footprints: A sequence giving, for each tile, an array
+          of the pixels it covers (see :func:`disc_footprints`).
+
+        :param nside: The resolution of the footprints.
+
+        :param nest: ``True`` if the footprints are in nested order.
+
+        """
+        npix = hp.nside2npix(nside)
+        ntiles = len(footprints)
+
+        pix = np.concatenate([np.asarray(f, dtype=int) for f in footprints])
+        tiles = np.repeat(np.arange(ntiles), [len(f) for f in footprints])
+
+        index = ss.csr_matrix((np.ones(pix.shape[0]), (pix, tiles)),
+                              shape=(npix, ntiles))
+        # Duplicate pixels in a footprint are summed; undo that.
+        index.data[:] = 1.0
+
+        self._nside = nside
+        self._nest = nest
+        self._index = index
+
+    @property
+    def nside(self):
+        """The resolution of the index.
+
+        """
+        return self._nside
+
+    @property
+    def nest(self):
+        """``True`` if the index is in nested order.
+
+        """
+        return self._nest
+
+    @property
+    def ntiles(self):
+        """The number of tiles.
+
+        """
+        return self._index.shape[1]
+
+    @property
+    def index(self):
+        """The ``(npix, ntiles)`` sparse (CSR) matrix whose non-zero
+        entries mark the tiles covering each pixel.
+
+        """
+        return self._index
+
+    def tile_probabilities(self, smap):
+        """Returns the probability in ``smap`` enclosed by each tile.
+
+        """
+        return self.index.T.dot(smap)
+
+class TiledSearch(object):
+    """A simulated search of a map by imaging tiles in order of the
+    probability they enclose.  Overlaps between tiles are accounted for
+    when computing the probability covered, but not when ranking.
+
+    """
+
+    def __init__(self, tile_index, smap, time_per_tile=1.0):
+        """Rank the tiles for searching the given map.
+
+        :param tile_index: A :class:`TileIndex` for the tiling.
+
+        :param smap: The search map (for example, from
+          :func:`sky_area.search.search_map`), at the resolution and in
+          the ordering of ``tile_index``.  Need not be normalised.
+
+        :param time_per_tile: The time taken to image each tile
+          (including any overheads).
+
+        """
+        smap = np.atleast_1d(smap)
+        if smap.shape[0] != hp.nside2npix(tile_index.nside):
+            raise ValueError('map resolution does not match the tile index')
+        smap = smap / np.sum(smap)
+
+        self._tile_index = tile_index
+        self._time_per_tile = time_per_tile
+
+        tile_probs = tile_index.tile_probabilities(smap)
+        self._tile_order = np.argsort(tile_probs)[::-1]
+
+        ntiles = tile_index.ntiles
+        tile_ranks = np.empty(ntiles, dtype=int)
+        tile_ranks[self._tile_order] = np.arange(ntiles)
+
+        # The rank of the first tile in the search that covers each
+        # pixel (ntiles if it is never covered).
+        index = tile_index.index
+        covered = np.diff(index.indptr) > 0
+        pixel_ranks = np.zeros(smap.shape[0], dtype=int) + ntiles
+        pixel_ranks[covered] = np.minimum.reduceat(tile_ranks[index.indices],
+                                                   index.indptr[:-1][covered])
+        self._pixel_ranks = pixel_ranks
+
+        self._cum_probs = np.cumsum(np.bincount(pixel_ranks[covered],
+                                                weights=smap[covered],
+                                                minlength=ntiles))
+
+    @property
+    def tile_index(self):
+        """The :class:`TileIndex` used in the search.
+
+        """
+        return self._tile_index
+
+    @property
+    def time_per_tile(self):
+        """The time taken to image each tile.
+
+        """
+        return self._time_per_tile
+
+    @property
+    def tile_order(self):
+        """The indices of the tiles in the order they are imaged.
+
+        """
+        return self._tile_order
+
+    @property
+    def cum_probs(self):
+        """The probability covered after imaging each tile in turn.
+
+        """
+        return self._cum_probs
+
+    def ntiles_cls(self, cls):
+        """Returns the number of tiles that must be imaged to cover each of
+        the credible levels ``cls`` (``inf`` if the tiling never
+        covers that much probability).
+
+        """
+        cls = np.atleast_1d(cls)
+
+        ntiles = np.searchsorted(self.cum_probs, cls) + 1.0
+        ntiles[ntiles > self.tile_index.ntiles] = np.inf
+
+        return ntiles
+
+    def ntiles_pts(self, ras, decs):
+        """Returns the number of tiles that must be imaged before each of the
+        points ``(ras, decs)`` is imaged (``inf`` if no tile covers
+        it).
+
+        """
+        ras = np.atleast_1d(ras)
+        decs = np.atleast_1d(decs)
+
+        ipix = hp.ang2pix(self.tile_index.nside, np.pi/2.0 - decs, ras,
+                          nest=self.tile_index.nest)
+
+        ntiles = self._pixel_ranks[ipix] + 1.0
+        ntiles[ntiles > self.tile_index.ntiles] = np.inf
+
+        return ntiles
+
+    def time_cls(self, cls):
+        """Returns the time taken to cover each of the credible levels
+        ``cls``.
+
+        """
+        return self.ntiles_cls(cls)*self.time_per_tile
+
+    def time_pts(self, ras, decs):
+        """Returns the time taken before each of the points ``(ras, decs)`` is
+        imaged.
+
+        """
+        return self.ntiles_pts(ras, decs)*self.time_per_tile
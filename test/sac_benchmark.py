@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""Times the stages of the clustered-KDE pipeline on synthetic sky
+posteriors, and writes the results as JSON so that performance can be
+tracked between versions.
+
+The synthetic posteriors vary the number of samples, the number of
+modes, where the modes sit (near the equator, near a pole, or across
+the RA = 0 = 2 pi wrap), and the resolution of the maps produced.
+
+"""
+
+import copy
+import json
+from optparse import OptionParser
+import platform
+import timeit
+
+import numpy as np
+import sky_area.search as sch
+import sky_area.sky_area_clustering as sac
+from sac_test import project_pts
+
+# The DEC, and a range of RA, in which the modes are centred.
+LOCATIONS = {'equator': (0.0, (0.5, 2.0*np.pi - 0.5)),
+             'pole': (np.pi/2.0 - 0.05, (0.0, 2.0*np.pi)),
+             'ra-wrap': (0.3, (-0.05, 0.05))}
+
+# The resolution of the slow map timed by default.
+SLOW_NSIDE = 32
+
+def draw_posterior(n, nmodes, location, width, random_state):
+    """Returns ``n`` RA-DEC samples from ``nmodes`` equally-weighted,
+    roughly Gaussian modes of angular size ``width`` centred near
+    ``location`` (a key of ``LOCATIONS``).
+
+    """
+    dec, (ra_low, ra_high) = LOCATIONS[location]
+
+    pts = []
+    for i, m in enumerate(np.array_split(np.arange(n), nmodes)):
+        ra = random_state.uniform(low=ra_low, high=ra_high)
+        # Spread the modes out in DEC, away from the pole.
+        d = dec - 0.3*i*np.sign(dec + 0.1)
+        centre = np.array([np.cos(ra)*np.cos(d), np.sin(ra)*np.cos(d), np.sin(d)])
+        pts.append(project_pts(centre + width*random_state.randn(m.shape[0], 3)))
+
+    return np.concatenate(pts, axis=0)
+
+def timed(f, *args, **kwargs):
+    """Returns ``(result, seconds)`` for the call ``f(*args, **kwargs)``.
+
+    """
+    start = timeit.default_timer()
+    result = f(*args, **kwargs)
+    return result, timeit.default_timer() - start
+
+def benchmark_kernels(skypost, nsmall=200, nrepeat=50, nlarge=6000):
+    """Times the posterior's kernel engine against summing the
+    ``gaussian_kde`` of each cluster, for ``nrepeat`` queries of
+    ``nsmall`` points and for one query of ``nlarge`` points, returning
+    a dictionary of timings in seconds.
+
+    """
+    def scipy_kdes(pts):
+        return sum(w*kde(pts.T) for kde, w in zip(skypost.kdes, skypost.weights))
+
+    pts = skypost.kde_pts[np.arange(nlarge) % skypost.kde_pts.shape[0]]
+
+    def repeated(f):
+        for i in range(nrepeat):
+            f(pts[:nsmall])
+
+    timings = {}
+    _, timings['small_scipy'] = timed(repeated, scipy_kdes)
+    _, timings['small_kernels'] = timed(repeated, skypost._kernels)
+    _, timings['large_scipy'] = timed(scipy_kdes, pts)
+    _, timings['large_kernels'] = timed(skypost._kernels, pts)
+
+    return timings
+
+def benchmark(n, nmodes, location, nside, width, ntrials, slow, random_state):
+    """Times each stage of the pipeline for one synthetic posterior,
+    returning a dictionary of timings in seconds.
+
+    """
+    pts = draw_posterior(n, nmodes, location, width, random_state)
+    true_pts = pts[:10, :]
+    pts = pts[10:, :]
+
+    timings = {}
+
+    skypost, timings['construct'] = timed(sac.ClusteredSkyKDEPosterior, pts,
+                                          ntrials=ntrials, random_state=random_state)
+    _, timings['k_means'] = timed(sac.k_means, skypost.kde_pts, skypost.k,
+                                  random_state=random_state)
+    # Re-optimise a copy, so that the stages below time the posterior
+    # as constructed.
+    _, timings['set_up_optimal_k'] = timed(copy.deepcopy(skypost)._set_up_optimal_k)
+
+    ranking_pts = skypost.ranking_pts.copy()
+    ranking_pts[:,1] = np.arcsin(ranking_pts[:,1])
+    _, timings['posterior'] = timed(skypost.posterior, ranking_pts)
+
+    _, timings['as_healpix_fast'] = timed(skypost.as_healpix, nside, fast=True)
+    _, timings['sky_area'] = timed(skypost.sky_area, [0.5, 0.75, 0.9])
+    _, timings['searched_area'] = timed(skypost.searched_area, true_pts)
+    _, timings['p_values'] = timed(skypost.p_values, true_pts)
+    # The slow map is costly at high resolution, so is only timed at
+    # the full nside if asked.
+    slow_nside = nside if slow else min(nside, SLOW_NSIDE)
+    _, timings['as_healpix_slow'] = timed(skypost.as_healpix, slow_nside, fast=False)
+
+    _, timings['search_map'] = timed(sch.search_map, pts[:,0], pts[:,1],
+                                     np.pi/180.0, pix_per_beam=4)
+
+    return {'n': n,
+            'nmodes': nmodes,
+            'location': location,
+            'nside': nside,
+            'slow_nside': slow_nside,
+            'width': width,
+            'k': skypost.k,
+            'timings': timings}
+
+if __name__ == '__main__':
+    parser = OptionParser()
+
+    parser.add_option('--output', default='sac_benchmark.json', help='output JSON file [default: %default]')
+    parser.add_option('--npts', default='1000,4000', help='comma-separated numbers of samples [default: %default]')
+    parser.add_option('--nmodes', default='1,3', help='comma-separated numbers of modes [default: %default]')
+    parser.add_option('--locations', default=','.join(sorted(LOCATIONS)), help='comma-separated mode locations [default: %default]')
+    parser.add_option('--nsides', default='64,256', help='comma-separated map resolutions [default: %default]')
+    parser.add_option('--width', type='float', default=0.05, help='angular size of each mode, in radians [default: %default]')
+    parser.add_option('--ntrials', type='int', default=2, help='k-means trials per k [default: %default]')
+    parser.add_option('--slow', action='store_true', default=False, help='time as_healpix(fast=False) at each nside [default: at nside {0:d} at most]'.format(SLOW_NSIDE))
+    parser.add_option('--kernels', action='store_true', default=False, help='also time the kernel engine against scipy gaussian_kde')
+    parser.add_option('--seed', type='int', default=0, help='random seed [default: %default]')
+
+    args, remaining = parser.parse_args()
+
+    random_state = np.random.RandomState(args.seed)
+
+    results = []
+    for n in [int(x) for x in args.npts.split(',')]:
+        for nmodes in [int(x) for x in args.nmodes.split(',')]:
+            for location in args.locations.split(','):
+                for nside in [int(x) for x in args.nsides.split(',')]:
+                    result = benchmark(n, nmodes, location, nside, args.width,
+                                       args.ntrials, args.slow, random_state)
+                    results.append(result)
+
+                    if args.kernels:
+                        skypost = sac.ClusteredSkyKDEPosterior(
+                            draw_posterior(n, nmodes, location, args.width, random_state),
+                            ntrials=args.ntrials, random_state=random_state)
+                        result['kernel_timings'] = benchmark_kernels(skypost)
+
+                    print('n = {0:d}, nmodes = {1:d}, location = {2:s}, nside = {3:d}: {4:.3g} s'.format(
+                        n, nmodes, location, nside, sum(result['timings'].values())))
+
+    with open(args.output, 'w') as out:
+        json.dump({'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'seed': args.seed,
+                   'results': results}, out, indent=2, sort_keys=True)
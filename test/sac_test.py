@@ -1,5 +1,5 @@
 import numpy as np
-import sky_area_clustering as sac
+import sky_area.sky_area_clustering as sac
 
 def project_pts(pts):
     """Returns the RA-DEC positions of three-dimensional points (not
@@ -34,6 +34,6 @@ def p_value(n):
     pt = pts[0,:]
     pts = pts[1:,:]
 
-    skypost = sac.ClusteredKDEPosterior(pts)
+    skypost = sac.ClusteredSkyKDEPosterior(pts)
 
     return skypost.p_values(np.reshape(pt, (1, 2)))[0]
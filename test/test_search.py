@@ -0,0 +1,59 @@
+import numpy as np
+import sky_area.search as sch
+
+def make_search_map(seed=0, n=2000, nest=True):
+    random_state = np.random.RandomState(seed)
+    ras = random_state.normal(1.0, 0.1, n)
+    decs = random_state.normal(0.3, 0.1, n)
+    return sch.search_map(ras, decs, np.pi/180.0, nest=nest, pix_per_beam=4)
+
+def test_search_map_index_matches_search_map_functions():
+    random_state = np.random.RandomState(1)
+    ras = random_state.uniform(0.6, 1.4, 50)
+    decs = random_state.uniform(-0.1, 0.7, 50)
+    cls = np.linspace(0.05, 0.95, 19)
+
+    for nest in [True, False]:
+        smap = make_search_map(nest=nest)
+        index = sch.SearchMapIndex(smap, nest=nest)
+
+        areas = [sch.search_map_searched_area_pt(smap, ra, dec, nest=nest)
+                 for ra, dec in zip(ras, decs)]
+        levels = [sch.search_map_credible_level_pt(smap, ra, dec, nest=nest)
+                  for ra, dec in zip(ras, decs)]
+        cl_areas = [sch.search_map_searched_area_cl(smap, cl) for cl in cls]
+
+        assert np.allclose(index.searched_area_pts(ras, decs), areas)
+        assert np.allclose(index.credible_level_pts(ras, decs), levels)
+        assert np.allclose(index.searched_area_cls(cls), cl_areas)
+
+def test_direct_smoothing_matches_harmonic():
+    random_state = np.random.RandomState(3)
+    ras = random_state.normal(1.0, 0.05, 2000)
+    decs = random_state.normal(0.3, 0.05, 2000)
+
+    for nest in [True, False]:
+        harmonic = sch.search_map(ras, decs, np.pi/180.0, nest=nest, pix_per_beam=4,
+                                  method='harmonic')
+        direct = sch.search_map(ras, decs, np.pi/180.0, nest=nest, pix_per_beam=4,
+                                method='direct')
+        assert np.allclose(direct, harmonic, rtol=0, atol=1e-4*np.max(harmonic))
+
+        # A compact posterior is smoothed directly by default.
+        auto = sch.search_map(ras, decs, np.pi/180.0, nest=nest, pix_per_beam=4)
+        assert np.all(auto == direct)
+
+def test_search_maps_match_single_beam_maps():
+    random_state = np.random.RandomState(4)
+    ras = random_state.normal(1.0, 0.05, 2000)
+    decs = random_state.normal(0.3, 0.05, 2000)
+    beams = [np.pi/180.0, 2.0*np.pi/180.0]
+
+    for method in ['harmonic', 'direct']:
+        smaps = sch.search_maps(ras, decs, beams, pix_per_beam=4, method=method)
+        for beam, smap in zip(beams, smaps):
+            # The same resolution as the maps for several beams.
+            single = sch.search_map(ras, decs, beam, pix_per_beam=4*beam/beams[0],
+                                    method='harmonic')
+            assert single.shape == smap.shape
+            assert np.allclose(smap, single, rtol=0, atol=1e-4*np.max(single))
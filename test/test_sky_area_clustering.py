@@ -0,0 +1,213 @@
+import pickle
+
+import numpy as np
+import sky_area.sky_area_clustering as sac
+
+# The attributes of a posterior pickled by the original version.
+BASELINE_ATTRIBUTES = ['_acc', '_pts', '_kde_pts', '_ranking_pts', '_ntrials', '_k',
+                       '_means', '_assign', '_kdes', '_weights', '_greedy_order',
+                       '_greedy_posteriors']
+
+def two_mode_pts(n, random_state):
+    """Returns ``2*n`` RA-DEC samples from two well-separated modes.
+
+    """
+    a = np.column_stack((random_state.normal(1.0, 0.05, n), random_state.normal(0.3, 0.05, n)))
+    b = np.column_stack((random_state.normal(4.0, 0.08, n), random_state.normal(-0.5, 0.05, n)))
+    return np.concatenate((a, b), axis=0)
+
+def many_mode_pts(n, random_state):
+    """Returns ``5*n`` RA-DEC samples from five well-separated modes, one
+    near the south pole.
+
+    """
+    centres = [(0.5, 0.8), (2.0, 0.2), (3.5, -0.4), (5.0, -1.0), (1.0, -0.3)]
+    return np.concatenate([np.column_stack((random_state.normal(ra, 0.05, n),
+                                            random_state.normal(dec, 0.05, n)))
+                           for ra, dec in centres], axis=0)
+
+def query_pts(pts, random_state, n=1000):
+    """Returns every fifth of ``pts`` and ``n`` points uniform on the sky.
+
+    """
+    uniform = np.column_stack((random_state.uniform(0, 2*np.pi, n),
+                               np.arcsin(random_state.uniform(-1, 1, n))))
+    return np.concatenate((pts[::5], uniform), axis=0)
+
+def make_posterior(n=500, seed=1, **kwargs):
+    random_state = np.random.RandomState(seed)
+    pts = two_mode_pts(n, random_state)
+    return pts, sac.ClusteredSkyKDEPosterior(pts, ntrials=1, random_state=random_state,
+                                             **kwargs)
+
+def test_baseline_pickle_round_trip():
+    pts, skypost = make_posterior()
+
+    old = object.__new__(sac.ClusteredSkyKDEPosterior)
+    for key in BASELINE_ATTRIBUTES:
+        setattr(old, key, getattr(skypost, key))
+    old._greedy_order = skypost.greedy_order
+    old._greedy_posteriors = skypost.greedy_posteriors
+
+    loaded = pickle.loads(pickle.dumps(old))
+
+    assert np.allclose(loaded.posterior(pts[:10]), skypost.posterior(pts[:10]))
+    assert np.allclose(loaded.sky_area([0.5, 0.9]), skypost.sky_area([0.5, 0.9]))
+    assert np.allclose(loaded.p_values(pts[:5]), skypost.p_values(pts[:5]))
+    assert np.allclose(loaded.as_healpix(8), skypost.as_healpix(8))
+    areas, errors = loaded.sky_area_direct([0.5], nboot=10)
+    assert np.all(np.isfinite(areas))
+    assert loaded.profile.as_dict()['area']['calls'] > 0
+
+def test_direct_areas_match_grid():
+    # Summing 1/p over the ranking points instead of draws from the KDE
+    # overestimates the 50% area of this posterior by about 20%.
+    pts, skypost = make_posterior(n=1000, seed=3)
+
+    cls = [0.5, 0.75]
+    areas, errors = skypost.sky_area_direct(cls, nboot=20, ndraws=20000)
+    assert np.allclose(areas, skypost.sky_area(cls), rtol=0.05)
+    assert np.all(errors < 0.25*areas)
+
+def test_direct_area_profiled_once():
+    pts, skypost = make_posterior()
+    skypost.sky_area_direct([0.999], nboot=5, max_rel_error=0.0)
+    assert skypost.profile.as_dict()['area']['calls'] == 1
+
+def test_direct_areas_bounded():
+    random_state = np.random.RandomState(5)
+    pts = two_mode_pts(1000, random_state)
+    outliers = np.column_stack((random_state.uniform(0, 2*np.pi, 10),
+                                np.arcsin(random_state.uniform(-1, 1, 10))))
+    pts = np.concatenate((pts, outliers))
+    weights = random_state.uniform(0.5, 1.5, pts.shape[0])
+
+    for kwargs in [{}, {'sample_weights': weights}]:
+        skypost = sac.ClusteredSkyKDEPosterior(pts, ntrials=1, random_state=random_state,
+                                               **kwargs)
+        areas, errors = skypost.sky_area_direct([0.995, 0.999, 1.0], nboot=20)
+        assert np.all(np.isfinite(areas))
+        assert np.all(areas <= 4.0*np.pi)
+        assert areas[-1] == 4.0*np.pi
+
+def test_update_reclusters_only_on_shift():
+    random_state = np.random.RandomState(7)
+    for n in [100, 1000, 4000]:
+        pts, skypost = make_posterior(n=1000, seed=n)
+        assert not skypost.update(two_mode_pts(n//2, random_state))
+
+    pts, skypost = make_posterior(n=1000, seed=3)
+    shifted = two_mode_pts(250, random_state)
+    shifted[:,0] += 0.3
+    assert skypost.update(shifted)
+
+def test_subsampled_clustering_matches_full():
+    pts = two_mode_pts(1500, np.random.RandomState(0))
+    full = sac.ClusteredSkyKDEPosterior(pts, ntrials=3, random_state=np.random.RandomState(0))
+    sub = sac.ClusteredSkyKDEPosterior(pts, ntrials=3, random_state=np.random.RandomState(0),
+                                       max_cluster_pts=400)
+
+    assert sub.clustering_npts == 400
+    assert full.clustering_npts == full.kde_pts.shape[0]
+    assert sub.k == full.k
+    assert np.allclose(sub.sky_area([0.5, 0.9]), full.sky_area([0.5, 0.9]), rtol=0.05)
+
+def test_parallel_evaluation_shares_one_pool(monkeypatch):
+    pts, skypost = make_posterior(max_memory=1<<16)
+    serial_post = skypost.posterior(pts)
+    serial_map = skypost.as_healpix(16, fast=False)
+
+    pools = []
+    def counting_pool(*args, **kwargs):
+        pool = mp_pool(*args, **kwargs)
+        pools.append(pool)
+        return pool
+    mp_pool = sac.mp.Pool
+    monkeypatch.setattr(sac.mp, 'Pool', counting_pool)
+
+    skypost.n_jobs = 2
+    skypost._min_parallel_work = 1
+    assert skypost._chunk_size(9) < pts.shape[0]
+
+    assert np.allclose(skypost.posterior(pts), serial_post)
+    assert len(pools) == 1
+    assert np.allclose(skypost.as_healpix(16, fast=False), serial_map)
+    assert len(pools) == 2
+    assert sac._forked_kernels is None
+
+def test_single_precision_posterior():
+    pts, skypost = make_posterior(n=2000)
+    post = skypost.posterior(pts)
+    assert np.allclose(skypost.posterior(pts, dtype=np.float32), post, rtol=1e-4, atol=0)
+
+def test_unit_weights_match_unweighted():
+    pts, skypost = make_posterior(seed=4)
+    pts, weighted = make_posterior(seed=4, sample_weights=np.ones(pts.shape[0]))
+
+    assert np.allclose(weighted.ranking_posteriors, skypost.ranking_posteriors)
+    cls = [0.5, 0.9, 1.0]
+    assert np.allclose(weighted.sky_area(cls), skypost.sky_area(cls))
+    assert weighted.sky_area(cls)[-1] == 4.0*np.pi
+    assert np.allclose(weighted.p_values(pts[:20]), skypost.p_values(pts[:20]))
+
+def test_update_small_batches():
+    pts, skypost = make_posterior(seed=6)
+    areas = skypost.sky_area([0.5])
+    nkde = skypost.kde_pts.shape[0]
+
+    assert not skypost.update(np.zeros((0, 2)))
+    assert np.allclose(skypost.sky_area([0.5]), areas)
+
+    assert not skypost.update(two_mode_pts(1, np.random.RandomState(8))[:1])
+    assert skypost.kde_pts.shape[0] == nkde + 1
+    assert skypost.clustering_npts == nkde + 1
+
+def test_pruned_posterior_within_tolerance():
+    random_state = np.random.RandomState(9)
+    pts = many_mode_pts(400, random_state)
+    skypost = sac.ClusteredSkyKDEPosterior(pts, ntrials=1, random_state=random_state)
+    assert skypost.k > 1
+
+    q = query_pts(pts, random_state)
+    exact = skypost.posterior(q)
+    for prune_tol in [1e-2, 1e-3]:
+        skypost.prune_tol = prune_tol
+        assert np.all(np.abs(skypost.posterior(q) - exact) <= prune_tol*np.max(exact))
+
+def test_binned_posterior_within_tolerance():
+    random_state = np.random.RandomState(9)
+    pts = many_mode_pts(400, random_state)
+    skypost = sac.ClusteredSkyKDEPosterior(pts, ntrials=1, random_state=random_state)
+
+    q = query_pts(pts, random_state)
+    exact = skypost.posterior(q)
+    for rtol in [1e-2, 1e-3]:
+        assert np.all(np.abs(skypost.posterior(q, rtol=rtol) - exact) <= rtol*np.max(exact))
+
+def test_reproducible_across_n_jobs(monkeypatch):
+    # Share even small evaluations among the workers.
+    monkeypatch.setattr(sac.ClusteredSkyKDEPosterior, '_min_parallel_work', 1)
+
+    pts, serial = make_posterior(seed=10, n_jobs=1)
+    pts, parallel = make_posterior(seed=10, n_jobs=2)
+
+    assert parallel.k == serial.k
+    assert np.all(parallel.ranking_posteriors == serial.ranking_posteriors)
+
+def test_spawn_random_states():
+    states = sac.spawn_random_states(11, 3)
+    again = sac.spawn_random_states(np.random.RandomState(11), 3)
+    draws = [s.randint(1<<30, size=5) for s in states]
+
+    assert all(np.all(d == s.randint(1<<30, size=5)) for d, s in zip(draws, again))
+    assert not np.all(draws[0] == draws[1])
+
+    # Each event's posterior depends only on its own state, so the order
+    # in which they are built does not matter.
+    pts = [two_mode_pts(300, np.random.RandomState(i)) for i in range(2)]
+    forward = [sac.ClusteredSkyKDEPosterior(p, ntrials=1, random_state=s)
+               for p, s in zip(pts, sac.spawn_random_states(12, 2))]
+    backward = [sac.ClusteredSkyKDEPosterior(p, ntrials=1, random_state=s)
+                for p, s in reversed(list(zip(pts, sac.spawn_random_states(12, 2))))][::-1]
+    for f, b in zip(forward, backward):
+        assert np.all(f.ranking_posteriors == b.ranking_posteriors)
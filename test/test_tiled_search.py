@@ -0,0 +1,58 @@
+import healpy as hp
+import numpy as np
+import sky_area.search as sch
+import sky_area.tiled_search as ts
+
+def brute_force_search(footprints, smap, order):
+    """Returns the probability covered after imaging each tile in
+    ``order``, and the number of tiles imaged before each pixel is
+    covered (``inf`` if never).
+
+    """
+    smap = smap / np.sum(smap)
+    covered = np.zeros(smap.shape[0], dtype=bool)
+    ntiles = np.zeros(smap.shape[0]) + np.inf
+
+    cum_probs = []
+    prob = 0.0
+    for i, tile in enumerate(order):
+        pix = np.unique(footprints[tile])
+        new = pix[~covered[pix]]
+        prob += np.sum(smap[new])
+        covered[new] = True
+        ntiles[new] = i + 1
+        cum_probs.append(prob)
+
+    return np.array(cum_probs), ntiles
+
+def test_tiled_search_matches_brute_force():
+    nside = 64
+    random_state = np.random.RandomState(2)
+    ras = random_state.normal(1.0, 0.08, 2000)
+    decs = random_state.normal(0.3, 0.08, 2000)
+    smap = sch.search_map(ras, decs, np.pi/180.0, pix_per_beam=4)
+    smap = hp.ud_grade(smap, nside, order_in='NESTED', order_out='NESTED', power=-2)
+
+    # Overlapping fields around the posterior, and some away from it.
+    tile_ras, tile_decs = np.meshgrid(np.linspace(0.5, 1.5, 12), np.linspace(-0.2, 0.8, 12))
+    footprints = ts.disc_footprints(nside, tile_ras.ravel(), tile_decs.ravel(), 0.06)
+
+    search = ts.TiledSearch(ts.TileIndex(footprints, nside), smap, time_per_tile=2.0)
+
+    tile_probs = [np.sum(smap[np.unique(f)]) for f in footprints]
+    assert np.all(np.diff(np.array(tile_probs)[search.tile_order]) <= 1e-12)
+
+    cum_probs, pixel_ntiles = brute_force_search(footprints, smap, search.tile_order)
+    assert np.allclose(search.cum_probs, cum_probs)
+
+    cls = np.linspace(0.05, 0.95, 19)
+    expected = [np.flatnonzero(cum_probs >= cl)[0] + 1 for cl in cls]
+    assert np.all(search.ntiles_cls(cls) == expected)
+    assert np.all(search.time_cls(cls) == 2.0*np.array(expected))
+    assert np.all(np.isinf(search.ntiles_cls([1.1])))
+
+    pt_ras = random_state.uniform(0.3, 1.7, 100)
+    pt_decs = random_state.uniform(-0.4, 1.0, 100)
+    ipix = hp.ang2pix(nside, np.pi/2.0 - pt_decs, pt_ras, nest=True)
+    assert np.all(search.ntiles_pts(pt_ras, pt_decs) == pixel_ntiles[ipix])
+    assert np.any(np.isinf(pixel_ntiles[ipix]))